@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmark of the DAQ read in NIGrabber.callback.
+
+Compares the old read (task.read returning nested python lists, converted
+with np.array) with NIDAQmxBackend.read_block, which uses a stream reader to
+fill a preallocated buffer. The NI driver is replaced by fake objects, so only
+the python side of the read is measured.
+
+Usage: python benchmarks/bench_callback_read.py [samples_per_scan]
+"""
+import os
+import sys
+import timeit
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fscv_backends
+
+
+class FakeTask:
+    """Mimics nidaqmx.Task.read: multi-channel data comes as nested lists"""
+    def __init__(self, source):
+        self.source = source
+
+    def read(self, number_of_samples_per_channel):
+        data = np.empty_like(self.source)
+        data[:] = self.source
+        return data.tolist()
+
+
+class FakeReader:
+    """Mimics the nidaqmx stream readers: the driver fills the given buffer"""
+    def __init__(self, source):
+        self.source = source
+
+    def read_many_sample(self, data, number_of_samples_per_channel):
+        data[:] = self.source
+        return number_of_samples_per_channel
+
+    def read_int16(self, data, number_of_samples_per_channel):
+        data[:] = self.source
+        return number_of_samples_per_channel
+
+
+def measure(func, n_calls=2000):
+    """Returns time per call [s] and peak allocated bytes per call"""
+    func()
+    t = timeit.timeit(func, number=n_calls) / n_calls
+
+    tracemalloc.start()
+    func()
+    tracemalloc.reset_peak()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return t, peak
+
+
+def main(samples_per_scan=1000):
+    source = np.random.normal(size=(2, samples_per_scan))
+    task = FakeTask(source)
+
+    backend = fscv_backends.NIDAQmxBackend()
+    backend.configure(2, samples_per_scan, 1, 100e3, 'float64')
+    backend.reader = FakeReader(source)
+    read_buffer = np.zeros((2, samples_per_scan))
+
+    def read_before():
+        return np.array(task.read(number_of_samples_per_channel=samples_per_scan))
+
+    print('samples per scan: %i, 2 channels' % samples_per_scan)
+    for name, func in [('before: np.array(task.read())', read_before),
+                       ('after:  backend.read_block()',
+                        lambda: backend.read_block(read_buffer))]:
+        t, peak = measure(func)
+        print('%-32s %8.2f us/callback %10i bytes allocated/callback' % (name, t*1e6, peak))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the compression settings of the scan arrays.
+
+Writes representative FSCV scans with every combination of compression
+library, shuffle mode, compression level, chunk size and scan encoding
+(int16 only), in batches like the writer thread of NIGrabber, and reads
+them back. With --threads the blosc settings are repeated for each number
+of compression threads, to show the scaling with the number of cores. The scans are
+synthetic (fscv_sim) or taken from a recording. Reported per setting:
+
+    write MB/s   uncompressed MB per second of appending and closing
+    ratio        uncompressed size / size on disk
+    read MB/s    uncompressed MB per second of reading all scans
+    last scan    time to read the last scan, like the live display [ms]
+
+Usage:
+    python benchmarks/bench_compression.py
+    python benchmarks/bench_compression.py --file data/fscv0003.h5 --sample-format int16
+    python benchmarks/bench_compression.py --complibs blosc:lz4,blosc:zstd --complevels 5
+    python benchmarks/bench_compression.py --sample-format int16 --encodings none,reference,previous
+    python benchmarks/bench_compression.py --complibs blosc:lz4,blosc:zstd --threads 1,2,4,8
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import numpy as np
+import tables as tb
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import fscv_daq
+import fscv_reader
+import fscv_sim
+
+
+def synthetic_scans(n_scans, samples_per_scan, sample_format, noise=5e-3):
+    """Electrode scans of the simulator, as ADC codes for int16"""
+    simulator = fscv_sim.FscvSimulator(samples_per_scan=samples_per_scan, noise=noise, seed=0)
+    block = np.empty((2, n_scans * samples_per_scan), dtype=fscv_daq.SAMPLE_ATOMS[sample_format].dtype)
+    simulator.read_block(block)
+    return block[1].reshape(n_scans, samples_per_scan)
+
+
+def recorded_scans(filename, n_scans, sample_format):
+    """The first n_scans scans of a recording, as ADC codes for int16"""
+    with fscv_reader.open_recording(filename) as data:
+        scans = data.scans.raw[:n_scans]
+        if sample_format == 'int16' and scans.dtype != np.int16:
+            scans = np.clip(np.round(scans / (10 / 2**15)), -2**15, 2**15 - 1)
+    return scans.astype(fscv_daq.SAMPLE_ATOMS[sample_format].dtype)
+
+
+def measure(scans, filename, filters, chunk_bytes, batch_scans, encoding='none',
+            reference_every=100):
+    """Write and read back scans with the given settings. Returns write MB/s,
+    compression ratio, read MB/s and the read time of the last scan [s]"""
+    n_scans, samples_per_scan = scans.shape
+    chunkshape = fscv_daq.scan_chunkshape(samples_per_scan, scans.itemsize, chunk_bytes)
+    mb = scans.nbytes / 1e6
+    atom = tb.Atom.from_dtype(scans.dtype)
+
+    t0 = time.perf_counter()
+    with tb.open_file(filename, mode='w') as fileh:
+        array = fileh.create_earray(fileh.root, 'array_scans', atom,
+                                    (0, samples_per_scan), filters=filters,
+                                    expectedrows=n_scans, chunkshape=chunkshape)
+        if encoding != 'none':
+            # Like fscv_daq.ScanFile
+            encoder = fscv_daq.DeltaEncoder(encoding, reference_every)
+            array.attrs['scan_encoding'] = encoding
+            array.attrs['reference_every'] = reference_every
+            references = fileh.create_earray(fileh.root, 'array_scans_reference', atom,
+                                             (0, samples_per_scan), filters=filters)
+        for start in range(0, n_scans, batch_scans):
+            batch = scans[start:start+batch_scans]
+            if encoding != 'none':
+                batch, new_references = encoder.encode(batch)
+                if new_references is not None and len(new_references):
+                    references.append(new_references)
+            array.append(batch)
+    t_write = time.perf_counter() - t0
+    ratio = scans.nbytes / os.path.getsize(filename)
+
+    with tb.open_file(filename) as fileh:
+        view = fscv_reader.scan_array(fileh.root.array_scans)
+        t0 = time.perf_counter()
+        data = view[:]
+        t_read = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        view[-1]
+        t_last = time.perf_counter() - t0
+    assert np.array_equal(data, scans)
+    return mb / t_write, ratio, mb / t_read, t_last
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of compression settings')
+    parser.add_argument('--file', help='recording to take the scans from, default: simulator')
+    parser.add_argument('--n-scans', type=int, default=2000)
+    parser.add_argument('--samples-per-scan', type=int, default=1000)
+    parser.add_argument('--noise', type=float, default=5e-3, help='simulator noise [V]')
+    parser.add_argument('--sample-format', default='float64', choices=list(fscv_daq.SAMPLE_ATOMS))
+    parser.add_argument('--complibs', default='blosc:lz4,blosc:zstd,blosc:blosclz,zlib')
+    parser.add_argument('--shuffles', default=','.join(fscv_daq.SHUFFLE_MODES))
+    parser.add_argument('--complevels', default='1,5,9')
+    parser.add_argument('--chunk-kb', default='32,128,1024', help='chunk sizes [kB]')
+    parser.add_argument('--encodings', default='none',
+                        help='scan encodings, see fscv_daq.SCAN_ENCODINGS (int16 only)')
+    parser.add_argument('--reference-every', type=int, default=100)
+    parser.add_argument('--batch-scans', type=int, default=10, help='scans per append')
+    parser.add_argument('--threads', default='1',
+                        help='numbers of blosc compression threads, e.g. 1,2,4 (cores: %i)'
+                        % os.cpu_count())
+    args = parser.parse_args(argv)
+
+    if args.file:
+        scans = recorded_scans(args.file, args.n_scans, args.sample_format)
+        source = args.file
+    else:
+        scans = synthetic_scans(args.n_scans, args.samples_per_scan, args.sample_format,
+                                args.noise)
+        source = 'simulator (noise %g V)' % args.noise
+    print('%s: %i scans x %i samples, %s, %.1f MB'
+          % (source, scans.shape[0], scans.shape[1], scans.dtype, scans.nbytes / 1e6))
+    print('%-14s %-10s %5s %6s %-9s %7s %9s %7s %9s %9s'
+          % ('complib', 'shuffle', 'level', 'chunk', 'encoding', 'threads', 'write', 'ratio',
+             'read', 'last scan'))
+
+    with tempfile.TemporaryDirectory() as folder:
+        filename = os.path.join(folder, 'bench.h5')
+        for complib in args.complibs.split(','):
+            for shuffle in args.shuffles.split(','):
+                for complevel in [int(c) for c in args.complevels.split(',')]:
+                    for chunk_kb in [int(c) for c in args.chunk_kb.split(',')]:
+                        try:
+                            filters = fscv_daq.make_filters(complevel, complib, shuffle)
+                        except ValueError:
+                            # e.g. bitshuffle without blosc
+                            continue
+                        for encoding in args.encodings.split(','):
+                            if encoding != 'none' and scans.dtype != np.int16:
+                                continue
+                            for threads in [int(t) for t in args.threads.split(',')]:
+                                # Only blosc uses threads
+                                if threads > 1 and not complib.startswith('blosc'):
+                                    continue
+                                tb.set_blosc_max_threads(threads)
+                                write, ratio, read, t_last = measure(
+                                    scans, filename, filters, chunk_kb * 1024,
+                                    args.batch_scans, encoding, args.reference_every)
+                                print('%-14s %-10s %5i %5ik %-9s %7i %6.0fMB/s %7.2f %6.0fMB/s '
+                                      '%7.2fms' % (complib, shuffle, complevel, chunk_kb,
+                                                   encoding, threads, write, ratio, read,
+                                                   t_last * 1e3), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""Acquisition backends: sources of blocks of scans for fscv_daq.NIGrabber.
+
+A backend delivers blocks of scans_per_callback consecutive scans of all
+channels (channel 0: command, 1..n: electrodes). The grabber configures it,
+starts it with a callback and reads each block from within that callback:
+
+    backend.configure(n_channels, samples_per_scan, scans_per_callback, rate,
+                      sample_format)
+    backend.start(callback)        # callback() is called for every block
+    backend.read_block(out)        # in the callback: fills out (channels, samples),
+                                   # None if there is no more data
+    backend.stop()
+
+Implementations:
+    NIDAQmxBackend: a National Instruments DAQ (nidaqmx)
+    SimulatorBackend: synthetic data of a fscv_sim.FscvSimulator
+    ReplayBackend: the scans of an existing recording
+
+The simulator and the replay are paced in real time or run as fast as
+possible, so the storage and GUI path can be tested without hardware.
+"""
+import time
+import threading
+import numpy as np
+
+import fscv_reader
+import fscv_sim
+
+try:
+    import nidaqmx
+    from nidaqmx import stream_readers  # Explicit import Required !
+    from nidaqmx.constants import AcquisitionType, OverwriteMode, ReadRelativeTo
+    NIDAQMX_AVAILABLE = True
+except ModuleNotFoundError:
+    NIDAQMX_AVAILABLE = False
+
+# DAQmx error of a read of samples that were already overwritten
+SAMPLES_NO_LONGER_AVAILABLE = -200279
+
+# Scaling of synthetic int16 data: the codes cover -10 V .. 10 V
+PHANTOM_SCALE_COEFFS = [0.0, 10/2**15]
+
+
+class AcquisitionBackend:
+    """Base class of the backends, see the module docstring"""
+    name = None
+
+    def configure(self, n_channels, samples_per_scan, scans_per_callback, rate,
+                  sample_format):
+        self.n_channels = n_channels
+        self.samples_per_scan = samples_per_scan
+        self.scans_per_callback = scans_per_callback
+        self.samples_per_callback = samples_per_scan * scans_per_callback
+        self.rate = rate
+        self.sample_format = sample_format
+
+    def start(self, callback):
+        raise NotImplementedError
+
+    def read_block(self, out):
+        """Read the next block into out and return it, None at the end of
+        the data"""
+        raise NotImplementedError
+
+    def stop(self):
+        """Stop delivering blocks, returns after the last callback"""
+        raise NotImplementedError
+
+    @property
+    def n_scans_read(self):
+        """Scans produced by the source up to the end of the last block read,
+        including scans that were lost before they could be read"""
+        raise NotImplementedError
+
+    @property
+    def n_scans_available(self):
+        """Scans produced by the source so far, read or not. Still valid
+        after stop()"""
+        return self.n_scans_read
+
+    @property
+    def scale_coeffs(self):
+        """Polynomial scaling coefficients of the channels for int16 data,
+        None for scaled data"""
+        if self.sample_format != 'int16':
+            return None
+        return [np.array(PHANTOM_SCALE_COEFFS)] * self.n_channels
+
+
+class BlockClock:
+    """Calls callback_function every period seconds from a thread.
+
+    With realtime False the callback is called as fast as possible. The
+    pacing uses an absolute schedule, so timing errors do not accumulate."""
+    def __init__(self, callback_function, period, realtime=True):
+        self.callback_function = callback_function
+        self.period = period
+        self.realtime = realtime
+        self.running = False
+        self.thread = threading.Thread(target=self.run)
+
+    def run(self):
+        t_next = time.perf_counter()
+        while self.running:
+            if self.realtime:
+                t_next += self.period
+                delay = t_next - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if self.running:
+                self.callback_function()
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join()
+
+
+class NIDAQmxBackend(AcquisitionBackend):
+    """Acquisition with a National Instruments DAQ.
+
+    Channels ai0..ai<n_channels-1> of device are sampled after each trigger
+    on PFI0. With one scan per callback each scan is a retriggered finite
+    acquisition, with more the sampling is continuous after the first
+    trigger."""
+    name = 'nidaqmx'
+
+    def __init__(self, device='PXI1Slot4_2', min_val=-10, max_val=10):
+        self.device = device
+        self.min_val = min_val
+        self.max_val = max_val
+        self.task = None
+        self.n_scans_acquired = None
+
+    def start(self, callback):
+        if not NIDAQMX_AVAILABLE:
+            raise RuntimeError('The nidaqmx backend requires the nidaqmx package')
+        self.task = nidaqmx.Task()
+        try:
+            self.setup_task(callback)
+            self.task.start()
+        except Exception:
+            # e.g. a missing device or invalid timing, the task is not left open
+            self.task.close()
+            self.task = None
+            raise
+
+    def setup_task(self, callback):
+        self.task.ai_channels.add_ai_voltage_chan("%s/ai0:%i" % (self.device, self.n_channels - 1),
+                                                  min_val=self.min_val, max_val=self.max_val)
+
+        if self.scans_per_callback == 1:
+            self.task.timing.cfg_samp_clk_timing(rate=self.rate,
+                                                 sample_mode=AcquisitionType.FINITE,
+                                                 samps_per_chan=self.samples_per_scan)
+        else:
+            # Continuous, samps_per_chan sets the size of the input buffer
+            self.task.timing.cfg_samp_clk_timing(rate=self.rate,
+                                                 sample_mode=AcquisitionType.CONTINUOUS,
+                                                 samps_per_chan=4*self.samples_per_callback)
+
+        def ni_callback(task_handle, every_n_samples_event_type,
+                        number_of_samples, callback_data):
+            callback()
+            return 0
+        self.task.register_every_n_samples_acquired_into_buffer_event(
+            self.samples_per_callback, ni_callback)
+
+        self.task.triggers.start_trigger.cfg_dig_edge_start_trig(
+            "/%s/PFI0" % self.device)
+
+        if self.scans_per_callback == 1:
+            self.task.triggers.start_trigger.retriggerable = True
+
+        # If the callback falls behind, unread scans are overwritten
+        # instead of stopping the task. Reading them fails, read_block then
+        # skips to the most recent block and the jump of the read position
+        # is recorded as a gap.
+        self.task.in_stream.over_write = OverwriteMode.OVERWRITE_UNREAD_SAMPLES
+
+        # Stream readers read directly into the read buffer
+        if self.sample_format == 'int16':
+            # Read unscaled ADC codes, the scaling is applied by the reader
+            self.reader = stream_readers.AnalogUnscaledReader(self.task.in_stream)
+        else:
+            self.reader = stream_readers.AnalogMultiChannelReader(self.task.in_stream)
+
+    def read_block(self, out):
+        """Read into the preallocated buffer out. No new arrays or python
+        lists are created. If the block was overwritten before it could be
+        read, the most recent complete block is read instead."""
+        try:
+            return self.read_next(out)
+        except nidaqmx.errors.DaqError as e:
+            if e.error_code != SAMPLES_NO_LONGER_AVAILABLE:
+                raise
+        return self.resync(out)
+
+    def read_next(self, out):
+        if self.sample_format == 'int16':
+            self.reader.read_int16(out, number_of_samples_per_channel=self.samples_per_callback)
+        else:
+            self.reader.read_many_sample(out,
+                                         number_of_samples_per_channel=self.samples_per_callback)
+        return out
+
+    def resync(self, out):
+        """Move the read position to the most recent complete block, counted
+        from total_samp_per_chan_acquired, and read that block. The skipped
+        scans show up in n_scans_read, the grabber records them as a gap."""
+        in_stream = self.task.in_stream
+        in_stream.relative_to = ReadRelativeTo.MOST_RECENT_SAMPLE
+        try:
+            while True:
+                acquired = in_stream.total_samp_per_chan_acquired
+                in_stream.offset = (-(acquired % self.samples_per_callback)
+                                    - self.samples_per_callback)
+                self.read_next(out)
+                # A block completed between reading the counter and the
+                # samples shifts the read off the block boundaries, retry
+                if in_stream.curr_read_pos % self.samples_per_callback == 0:
+                    return out
+        finally:
+            in_stream.relative_to = ReadRelativeTo.CURRENT_READ_POSITION
+            in_stream.offset = 0
+
+    def stop(self):
+        if self.task is None:
+            # Not started
+            return
+        self.task.stop()
+        # The counter can not be read from a closed task
+        self.n_scans_acquired = (self.task.in_stream.total_samp_per_chan_acquired
+                                 // self.samples_per_scan)
+        self.task.close()
+        self.task = None
+
+    @property
+    def n_scans_read(self):
+        return self.task.in_stream.curr_read_pos // self.samples_per_scan
+
+    @property
+    def n_scans_available(self):
+        return self.n_scans_acquired
+
+    @property
+    def scale_coeffs(self):
+        if self.sample_format != 'int16':
+            return None
+        return [np.array(channel.ai_dev_scaling_coeff) for channel in self.task.ai_channels]
+
+
+class SimulatorBackend(AcquisitionBackend):
+    """Synthetic scans of a fscv_sim.FscvSimulator, paced in real time or
+    (realtime=False) as fast as possible. Without a simulator, one with the
+    default parameters is created."""
+    name = 'simulator'
+
+    def __init__(self, simulator=None, realtime=True):
+        self.simulator = simulator
+        self.realtime = realtime
+
+    def configure(self, n_channels, samples_per_scan, scans_per_callback, rate,
+                  sample_format):
+        super().configure(n_channels, samples_per_scan, scans_per_callback, rate,
+                          sample_format)
+        if self.simulator is None:
+            self.simulator = fscv_sim.FscvSimulator(samples_per_scan=samples_per_scan,
+                                                    rate=rate,
+                                                    scan_frequency=rate/samples_per_scan,
+                                                    n_electrodes=n_channels - 1)
+
+    def start(self, callback):
+        self.clock = BlockClock(callback, period=self.samples_per_callback/self.rate,
+                                realtime=self.realtime)
+        self.clock.start()
+
+    def read_block(self, out):
+        return self.simulator.read_block(out)
+
+    def stop(self):
+        self.clock.stop()
+
+    @property
+    def n_scans_read(self):
+        return self.simulator.n_scans_generated
+
+
+class ReplayBackend(AcquisitionBackend):
+    """Replays the scans of a recording (a .h5 file or the manifest of a
+    segmented recording), in real time or (realtime=False) as fast as
+    possible.
+
+    The recording needs the same number of samples per scan and at least as
+    many electrodes. int16 recordings are replayed with their ADC codes and
+    scaling coefficients. With loop the recording starts over at its end,
+    otherwise the replay stops there and finished is set.
+
+    The scans are read while replaying, read_ahead blocks at a time, so
+    only these are held in memory."""
+    name = 'replay'
+
+    def __init__(self, filename, realtime=True, loop=False, read_ahead=10):
+        self.filename = filename
+        self.realtime = realtime
+        self.loop = loop
+        self.read_ahead = read_ahead
+        self.finished = False
+        self.position = 0
+        self.n_replayed = 0
+        self.recording = None
+
+    def configure(self, n_channels, samples_per_scan, scans_per_callback, rate,
+                  sample_format):
+        super().configure(n_channels, samples_per_scan, scans_per_callback, rate,
+                          sample_format)
+        with fscv_reader.open_recording(self.filename) as recording:
+            if recording.samples_per_scan != samples_per_scan:
+                raise ValueError('Recording has %i samples per scan, not %i'
+                                 % (recording.samples_per_scan, samples_per_scan))
+            if recording.n_electrodes < n_channels - 1:
+                raise ValueError('Recording has only %i electrodes' % recording.n_electrodes)
+            if len(recording) < scans_per_callback:
+                raise ValueError('Recording is shorter than one block')
+
+            channels = [recording.command] + recording.electrodes[:n_channels-1]
+            # Replay int16 codes unchanged if possible
+            self.replay_raw = (sample_format == 'int16'
+                               and all(c.scale_coeffs is not None for c in channels))
+            self._scale_coeffs = None
+            if self.replay_raw:
+                self._scale_coeffs = [c.scale_coeffs for c in channels]
+            self.n_scans = len(recording)
+
+    def replayed_channels(self, recording):
+        """Lazy arrays of the command and the replayed electrodes"""
+        channels = [recording.command] + recording.electrodes[:self.n_channels-1]
+        if self.replay_raw:
+            return [c.raw for c in channels]
+        return channels
+
+    def start(self, callback):
+        self.recording = fscv_reader.open_recording(self.filename)
+        self.channels = self.replayed_channels(self.recording)
+        self.chunk = None
+        self.clock = BlockClock(callback, period=self.samples_per_callback/self.rate,
+                                realtime=self.realtime)
+        self.clock.start()
+
+    def read_chunk(self, start):
+        """Read up to read_ahead blocks from scan start on. Runs on the clock
+        thread while the writer thread of the grabber may use PyTables."""
+        n_blocks = min(self.read_ahead, (self.n_scans - start) // self.scans_per_callback)
+        stop = start + n_blocks * self.scans_per_callback
+        with fscv_reader.TABLES_LOCK:
+            self.chunk = [np.asarray(c[start:stop]) for c in self.channels]
+        self.chunk_start = start
+
+    def read_block(self, out):
+        n_scans = self.scans_per_callback
+        start = self.position
+        if start + n_scans > self.n_scans:
+            if not self.loop:
+                # Stop delivering blocks
+                self.finished = True
+                self.clock.running = False
+                return None
+            start = 0
+        if (self.chunk is None or start < self.chunk_start
+                or start + n_scans > self.chunk_start + len(self.chunk[0])):
+            self.read_chunk(start)
+        offset = start - self.chunk_start
+        for i, channel in enumerate(self.chunk):
+            # (n_scans, samples) -> one channel of the block
+            data = channel[offset:offset+n_scans].reshape(-1)
+            if np.issubdtype(out.dtype, np.integer) and not self.replay_raw:
+                data = np.clip(np.round(data / PHANTOM_SCALE_COEFFS[1]),
+                               np.iinfo(out.dtype).min, np.iinfo(out.dtype).max)
+            out[i] = data
+        self.position = start + n_scans
+        self.n_replayed += n_scans
+        return out
+
+    def stop(self):
+        self.clock.stop()
+        if self.recording is not None:
+            with fscv_reader.TABLES_LOCK:
+                self.recording.close()
+            self.recording = None
+            self.chunk = None
+
+    @property
+    def n_scans_read(self):
+        return self.n_replayed
+
+    @property
+    def scale_coeffs(self):
+        if self.sample_format != 'int16':
+            return None
+        if self.replay_raw:
+            return self._scale_coeffs
+        return super().scale_coeffs
+
+
+# Backends by name, e.g. for a selection in the GUI
+BACKENDS = {'nidaqmx': NIDAQmxBackend,
+            'simulator': SimulatorBackend,
+            'replay': ReplayBackend}
+
+
+def default_backend():
+    """The NI DAQ if nidaqmx is installed, otherwise the simulator"""
+    if NIDAQMX_AVAILABLE:
+        return NIDAQmxBackend()
+    return SimulatorBackend()
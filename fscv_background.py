@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Background subtraction of the live scans.
+
+BackgroundEngine subtracts a background from every scan of one electrode
+and updates it incrementally, O(samples_per_scan) per scan. The background
+can be
+
+    'file'          fixed, e.g. the mean of a background recording
+    'rolling'       the mean of the last n_scans scans before each scan
+    'before chord'  the mean of the last n_scans scans before the latest
+                    chord change of the symphony
+    'marked'        the mean of the scans between two marks of the user
+
+Chord changes and marks are events at a scan index, they take effect
+exactly at that scan even if the scans are processed later in blocks.
+
+The GUI stores a preview of the subtracted scans (every preview_every-th
+scan, float32) next to the recording, see write_preview.
+
+Example:
+    engine = BackgroundEngine(1000, mode='before chord', n_scans=50)
+    subtracted = engine.add(scans, first_index=0)
+    engine.add_event('chord', 1200)
+"""
+import os
+import numpy as np
+
+import fscv_reader
+
+BACKGROUND_MODES = ['file', 'rolling', 'before chord', 'marked']
+EVENT_KINDS = ['chord', 'mark']
+
+
+class BackgroundEngine:
+    """Background subtraction of the scans of one electrode, see the module
+    docstring. background is the fixed background of mode 'file'."""
+    def __init__(self, samples_per_scan, mode='file', n_scans=50, background=None):
+        if mode not in BACKGROUND_MODES:
+            raise ValueError('Unknown background mode: %s' % mode)
+        self.mode = mode
+        self.n_scans = max(1, int(n_scans))
+        self.background = None if background is None else np.asarray(background, np.float64)
+
+        # The last n_scans scans and their sum. The sum is recomputed from
+        # the window every n_scans scans, so rounding errors do not add up.
+        self.window = np.zeros((self.n_scans, samples_per_scan))
+        self.window_sum = np.zeros(samples_per_scan)
+        self.n_seen = 0
+
+        # Sum of the scans since the first mark, None if not marking
+        self.mark_sum = None
+        self.mark_n = 0
+
+        # Pending events (scan index, kind), sorted by scan index
+        self.events = []
+
+    def add_event(self, kind, scan_index):
+        """A chord change or a mark at scan_index (counted like first_index
+        of add). It takes effect before that scan is processed."""
+        if kind not in EVENT_KINDS:
+            raise ValueError('Unknown background event: %s' % kind)
+        self.events.append((scan_index, kind))
+        self.events.sort()
+
+    def handle_event(self, kind):
+        if kind == 'chord' and self.mode == 'before chord':
+            self.background = self.window_mean()
+        elif kind == 'mark' and self.mode == 'marked':
+            if self.mark_sum is None:
+                self.mark_sum = np.zeros_like(self.window_sum)
+                self.mark_n = 0
+            else:
+                if self.mark_n:
+                    self.background = self.mark_sum / self.mark_n
+                self.mark_sum = None
+
+    @property
+    def marking(self):
+        return self.mark_sum is not None
+
+    def window_mean(self):
+        if self.n_seen == 0:
+            return None
+        return self.window_sum / min(self.n_seen, self.n_scans)
+
+    def push(self, scan):
+        """Add a scan to the window (and the marked scans)"""
+        slot = self.n_seen % self.n_scans
+        self.window_sum -= self.window[slot]
+        self.window[slot] = scan
+        self.window_sum += scan
+        self.n_seen += 1
+        if slot == self.n_scans - 1:
+            self.window_sum = self.window.sum(0)
+        if self.mark_sum is not None:
+            self.mark_sum += scan
+            self.mark_n += 1
+
+    def add(self, scans, first_index):
+        """Subtract the background from scans (n_scans, samples), the first
+        has the index first_index. Returns the subtracted scans, unchanged
+        while there is no background."""
+        scans = np.asarray(scans, dtype=np.float64)
+        subtracted = np.empty_like(scans)
+        for i, scan in enumerate(scans):
+            while self.events and self.events[0][0] <= first_index + i:
+                self.handle_event(self.events.pop(0)[1])
+            if self.mode == 'rolling':
+                self.background = self.window_mean()
+            if self.background is None:
+                subtracted[i] = scan
+            else:
+                subtracted[i] = scan - self.background
+            self.push(scan)
+        return subtracted
+
+
+def preview_filename(filename):
+    """Preview of a recording, e.g. fscv0001.h5, fscv0001.json or
+    fscv0001.npyrec -> fscv0001_preview.npz"""
+    filename = os.path.normpath(str(filename))
+    if os.path.basename(filename) == fscv_reader.NPY_METADATA:
+        filename = os.path.dirname(filename)
+    return os.path.splitext(filename)[0] + '_preview.npz'
+
+
+def write_preview(filename, ts, index, scans, **settings):
+    """Store the background subtracted preview of a recording: timestamps,
+    scan indices (counted from the start of the acquisition) and scans.
+    settings (mode, n_scans, ...) are stored with it."""
+    preview = preview_filename(filename)
+    np.savez(preview, ts=np.asarray(ts, np.float64), index=np.asarray(index, np.int64),
+             scans=np.asarray(scans, np.float32).reshape(len(ts), -1),
+             **{k: np.asarray(v) for k, v in settings.items()})
+    return preview
+
+
+def read_preview(filename):
+    """The preview of a recording as a dict of arrays (ts, index, scans and
+    the settings)"""
+    with np.load(preview_filename(filename)) as data:
+        return {name: data[name] for name in data.files}
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Conversion between the storages of recordings: HDF5 (.h5, or the
+manifest of a segmented recording) and npy (a .npyrec directory of
+memory-mapped .npy segments, see fscv_reader).
+
+The scans are copied unscaled with their scaling coefficients, timestamps,
+timing, gaps, flushes and the recording parameters. Template commands and
+delta encoded scans are decoded, the output stores them in full.
+
+Usage:
+    python fscv_convert.py fscv0001.h5                 # -> fscv0001.npyrec
+    python fscv_convert.py fscv0001.npyrec             # -> fscv0001.h5
+    python fscv_convert.py fscv0001.json -o /data/fscv0001.npyrec
+"""
+import os
+import sys
+import argparse
+import numpy as np
+
+import fscv_daq
+import fscv_reader
+
+# Attributes that describe the storage of the source, not the recording
+STORAGE_ATTRS = ['storage', 'complevel', 'complib', 'shuffle', 'segment']
+
+
+def recording_attrs(recording):
+    """Recording parameters as a dict, for all kinds of recordings"""
+    attrs = recording.attrs
+    if hasattr(attrs, '_v_attrnamesuser'):
+        return {name: attrs[name] for name in attrs._v_attrnamesuser}
+    return dict(attrs)
+
+
+def converted_filename(filename):
+    """fscv0001.h5/.json -> fscv0001.npyrec, fscv0001.npyrec -> fscv0001.h5"""
+    filename = os.path.normpath(str(filename))
+    if os.path.basename(filename) == fscv_reader.NPY_METADATA:
+        filename = os.path.dirname(filename)
+    if filename.endswith(fscv_reader.NPY_SUFFIX):
+        return os.path.splitext(filename)[0] + '.h5'
+    return fscv_reader.npy_dirname(filename)
+
+
+def convert(filename, out_filename=None, complevel=5, block_scans=1000):
+    """Copy a recording into the other storage, the storage of out_filename
+    is given by its suffix. Returns the filename of the copy."""
+    if out_filename is None:
+        out_filename = converted_filename(filename)
+    storage = 'npy' if str(out_filename).endswith(fscv_reader.NPY_SUFFIX) else 'hdf5'
+
+    with fscv_reader.open_recording(filename) as src:
+        channels = [src.command] + src.electrodes
+        sample_format = src.scans.attrs['sample_format'] if 'sample_format' in src.scans.attrs \
+            else src.scans.raw.dtype.name
+        out = fscv_daq.STORAGES[storage](out_filename, n_electrodes=src.n_electrodes,
+                                         samples_per_scan=src.samples_per_scan,
+                                         sample_format=sample_format, scan_major=True,
+                                         complevel=complevel, expectedrows=max(len(src), 1))
+        attrs = recording_attrs(src)
+        out.set_attrs({k: v for k, v in attrs.items() if k not in STORAGE_ATTRS})
+        out.set_attrs({'converted_from': os.path.basename(os.path.normpath(str(filename)))})
+        if src.scans.scale_coeffs is not None:
+            out.set_scale_coeffs([c.scale_coeffs for c in channels])
+
+        for start in range(0, len(src), block_scans):
+            stop = min(start + block_scans, len(src))
+            data = np.stack([c.raw[start:stop] for c in channels], axis=1)
+            if src.timing is not None:
+                timing = src.timing[start:stop]
+            else:
+                timing = np.full((stop - start, len(fscv_daq.TIMING_COLUMNS)), np.nan)
+            out.append(src.ts[start:stop], data, timing)
+
+        for name in ['gaps', 'flushes']:
+            events = getattr(src, name)
+            if events is not None and len(events):
+                getattr(out, 'array_' + name).append(events[:])
+        n_scans = len(out)
+        out.close()
+    print('%s: %i scans converted' % (filename, n_scans))
+    return out.filename
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert a FSCV recording between the '
+                                     'HDF5 and the npy storage')
+    parser.add_argument('filename', help='.h5 file, manifest (.json) or .npyrec directory')
+    parser.add_argument('-o', '--output', help='output .h5 file or .npyrec directory')
+    parser.add_argument('--complevel', type=int, default=5, help='for .h5 output')
+    args = parser.parse_args(argv)
+    print('saved: ', convert(args.filename, args.output, args.complevel))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
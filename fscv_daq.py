@@ -1,88 +1,1031 @@
+import os
 import time
+import shutil
 import tables as tb
 import numpy as np
 import threading
 
-try:
-    import nidaqmx
-    from nidaqmx.constants import AcquisitionType
-    REAL_DATA = True
-except ModuleNotFoundError:
-    # If nidaqmx is not installed, random data is generated
-    REAL_DATA = False
+import fscv_reader
+import fscv_backends
+
+
+# Storage formats of the samples. int16 stores the unscaled ADC codes, the
+# polynomial scaling coefficients are stored in the 'scale_coeffs' attribute
+SAMPLE_ATOMS = {'float64': tb.Float64Atom(),
+                'float32': tb.Float32Atom(),
+                'int16': tb.Int16Atom()}
+
+# Columns of the per-scan timing array (array_timing), in seconds:
+# callback entry (since start), duration of the DAQ read, duration of the
+# copy into the write queue and interval to the previous scan (trigger)
+TIMING_COLUMNS = ['callback_time', 'read_duration', 'enqueue_duration', 'trigger_interval']
+ENQUEUE_DURATION = TIMING_COLUMNS.index('enqueue_duration')
+
+# Fraction of the segment size or duration at which the next segment file
+# is created
+SEGMENT_PREPARE_FILL = 0.9
+
+# Number of recent trigger intervals kept for the live histogram
+N_RECENT_INTERVALS = 1000
+
+# Columns of the gap events (array_gaps): index of the first scan in the
+# file after the gap, number of missing scans, time and kind of the gap.
+# 'counter': the sample counter of the DAQ (or simulator) jumped, i.e. the
+# scans were overwritten before they were read. 'overflow': the scans were
+# read but the write queue was full. 'unread': scans acquired by the DAQ
+# that were never read when the acquisition stopped.
+GAP_COLUMNS = ['scan_index', 'n_missing', 'time', 'kind']
+GAP_KINDS = ['counter', 'overflow', 'unread']
+
+# Storage of the command voltage. 'full': every scan. 'template': the first
+# scan of the file is stored as template, for every scan only the deviation
+# from it (COMMAND_STATS_COLUMNS, in volts). Full scans are stored if the
+# maximum deviation exceeds a threshold and every command_keep_every-th
+# scan for QA. fscv_reader reconstructs the command of the other scans
+# from the template.
+COMMAND_MODES = ['full', 'template']
+COMMAND_STATS_COLUMNS = ['max_abs_deviation', 'rms_deviation', 'mean_deviation']
+
+# Lossless encoding of int16 scans before compression, see DeltaEncoder.
+# 'reference': difference to a reference scan, the first scan of every
+# block of reference_every scans, stored in <array>_reference.
+# 'previous': difference to the previous scan, the first scan of every block
+# is stored unchanged.
+SCAN_ENCODINGS = ['none', 'reference', 'previous']
+
+# Storages of the recordings: 'hdf5' (ScanFile) or 'npy' (NpyScanFile), a
+# directory of memory-mapped .npy segments of about NPY_SEGMENT_BYTES
+STORAGE_NAMES = ['hdf5', 'npy']
+NPY_SEGMENT_BYTES = 2**26
+
+# Columns of the flush log (array_flushes): time of the flush (since start),
+# its duration and the number of scans in the file after the flush. A
+# crashed recording is consistent up to the last flush.
+FLUSH_COLUMNS = ['time', 'duration', 'n_scans']
+
+# The writer spends at most this fraction of its time flushing: after a
+# flush that took d seconds, the next one is not before d / FLUSH_MAX_DUTY
+FLUSH_MAX_DUTY = 0.1
+
+
+# Compression libraries and shuffle filters of the data arrays, see
+# benchmarks/bench_compression.py. 'blosc' is blosc with its default
+# compressor (blosclz)
+COMPLIBS = ['blosc', 'blosc:lz4', 'blosc:lz4hc', 'blosc:zstd', 'blosc:blosclz',
+            'blosc:zlib', 'zlib']
+SHUFFLE_MODES = ['shuffle', 'bitshuffle', 'none']
+
+
+def make_filters(complevel, complib='blosc', shuffle='shuffle'):
+    """PyTables filters of the data arrays"""
+    if complib not in COMPLIBS:
+        raise ValueError('Unknown compression library: %s' % complib)
+    if shuffle not in SHUFFLE_MODES:
+        raise ValueError('Unknown shuffle mode: %s' % shuffle)
+    if shuffle == 'bitshuffle' and not complib.startswith('blosc'):
+        raise ValueError('bitshuffle is only available with blosc')
+    return tb.Filters(complevel=complevel, complib=complib,
+                      shuffle=shuffle == 'shuffle', bitshuffle=shuffle == 'bitshuffle')
+
+
+def filters_shuffle(filters):
+    """Shuffle mode of PyTables filters, see SHUFFLE_MODES"""
+    if filters.bitshuffle:
+        return 'bitshuffle'
+    return 'shuffle' if filters.shuffle else 'none'
+
+
+def scan_chunkshape(samples_per_scan, itemsize, chunk_bytes=2**17):
+    """Chunkshape of a scan-major array, a chunk holds only whole scans"""
+    scans_per_chunk = max(1, chunk_bytes // (samples_per_scan * itemsize))
+    return (scans_per_chunk, samples_per_scan)
+
+
+class DeltaEncoder:
+    """Scan-to-scan delta encoding of the int16 scans of one array, see
+    SCAN_ENCODINGS. The differences wrap around like int16 arithmetic, so
+    they fit into int16 and decoding (fscv_reader.DeltaScanArray) is exact.
+    They are zigzag mapped (0, -1, 1, -2, ... -> 0, 1, 2, 3, ...), so small
+    differences of either sign have a zero high byte, which the shuffle
+    filter compresses well. A block of reference_every scans can be decoded
+    on its own."""
+    def __init__(self, encoding, reference_every):
+        self.encoding = encoding
+        self.reference_every = reference_every
+        self.n_scans = 0
+        # Current reference scan or last scan
+        self.last = None
+
+    def encode(self, scans):
+        """Differences of the scans (n_scans, samples) and the new reference
+        scans to store (None for 'previous')"""
+        index = self.n_scans + np.arange(len(scans))
+        block_start = index % self.reference_every == 0
+        self.n_scans += len(scans)
+
+        if self.encoding == 'reference':
+            last = np.zeros_like(scans[:1]) if self.last is None else self.last[np.newaxis]
+            references = np.concatenate([last, scans[block_start]])
+            self.last = references[-1]
+            return self.zigzag(scans - references[np.cumsum(block_start)]), references[1:]
+
+        previous = np.empty_like(scans)
+        previous[0] = 0 if self.last is None else self.last
+        previous[1:] = scans[:-1]
+        previous[block_start] = 0
+        self.last = scans[-1].copy()
+        return self.zigzag(scans - previous), None
+
+    @staticmethod
+    def zigzag(deltas):
+        """Zigzag mapping of int16 differences, inverse of fscv_reader.unzigzag"""
+        return (deltas << 1) ^ (deltas >> 15)
+
+
+class ScanRingBuffer:
+    """Preallocated ring buffer between the DAQ callback and the writer thread.
+
+    The callback only copies scans into the buffer (put), the writer thread
+    takes them out (peek/release). If the writer falls behind and the buffer
+    is full, new scans are dropped and counted in n_overflow. Every scan has
+    a row of timing information (see TIMING_COLUMNS), the duration of the
+    copy into the buffer is measured here."""
+    def __init__(self, depth, n_channels, samples_per_scan, dtype=np.float64):
+        self.depth = depth
+        self.ts = np.zeros(depth)
+        self.data = np.zeros((depth, n_channels, samples_per_scan), dtype=dtype)
+        self.timing = np.zeros((depth, len(TIMING_COLUMNS)))
+
+        self.n_put = 0
+        self.n_get = 0
+        self.n_overflow = 0
+        self.high_water = 0
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return self.n_put - self.n_get
+
+    def put(self, t, data, timing):
+        """Copy one scan into the buffer. Returns False if the buffer is full"""
+        if self.n_put - self.n_get >= self.depth:
+            self.n_overflow += 1
+            return False
+
+        # Only the callback writes to this slot, no lock needed for the copy
+        t_start = time.perf_counter()
+        slot = self.n_put % self.depth
+        self.ts[slot] = t
+        self.data[slot] = data
+        self.timing[slot] = timing
+        self.timing[slot, ENQUEUE_DURATION] = time.perf_counter() - t_start
+
+        with self.condition:
+            self.n_put += 1
+            self.high_water = max(self.high_water, self.n_put - self.n_get)
+            self.condition.notify()
+        return True
+
+    def put_many(self, ts, data, timing):
+        """Copy a block of scans into the buffer. Scans that do not fit are
+        dropped, returns the number of stored scans"""
+        n = min(len(ts), self.depth - (self.n_put - self.n_get))
+        self.n_overflow += len(ts) - n
+
+        # The block may wrap around the end of the buffer
+        t_start = time.perf_counter()
+        start = self.n_put % self.depth
+        n_first = min(n, self.depth - start)
+        self.ts[start:start+n_first] = ts[:n_first]
+        self.data[start:start+n_first] = data[:n_first]
+        self.timing[start:start+n_first] = timing[:n_first]
+        self.ts[:n-n_first] = ts[n_first:n]
+        self.data[:n-n_first] = data[n_first:n]
+        self.timing[:n-n_first] = timing[n_first:n]
+        enqueue_duration = time.perf_counter() - t_start
+        self.timing[start:start+n_first, ENQUEUE_DURATION] = enqueue_duration
+        self.timing[:n-n_first, ENQUEUE_DURATION] = enqueue_duration
+
+        with self.condition:
+            self.n_put += n
+            self.high_water = max(self.high_water, self.n_put - self.n_get)
+            self.condition.notify()
+        return n
+
+    def wait(self, n, timeout):
+        """Wait until at least n scans are queued or the timeout expired,
+        returns the number of queued scans"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.n_put - self.n_get >= n, timeout)
+            return self.n_put - self.n_get
+
+    def oldest_ts(self):
+        """Timestamp of the oldest queued scan"""
+        return self.ts[self.n_get % self.depth]
+
+    def peek(self, n):
+        """Views of the next (at most n) queued scans without copying. The
+        views are only valid until release() is called."""
+        n = min(n, self.n_put - self.n_get)
+        start = self.n_get % self.depth
+        stop = min(start + n, self.depth)
+        return self.ts[start:stop], self.data[start:stop], self.timing[start:stop]
+
+    def release(self, n):
+        """Mark n scans as written, their slots can be reused"""
+        with self.condition:
+            self.n_get += n
+
+
+class LiveScanBuffer:
+    """The latest scans of all channels in memory, for the live display.
+
+    There is one writer (the DAQ callback), the oldest scans are
+    overwritten. Every scan is written twice, at its slot and at slot +
+    n_slots, so the latest n scans are always one contiguous slice and a
+    snapshot is a view without copying. A snapshot stays valid while
+    headroom more scans arrive, see LiveSnapshot.valid. The header holds the
+    number of scans put so far and the number of scans whose slots are being
+    written, readers use the latter to check that their views were not
+    overwritten."""
+    def __init__(self, depth, n_channels, samples_per_scan, dtype=np.float64,
+                 headroom=None):
+        self.depth = depth
+        self.headroom = max(1, depth // 4) if headroom is None else headroom
+        self.n_slots = self.depth + self.headroom
+        self.n_channels = n_channels
+        self.samples_per_scan = samples_per_scan
+        self.dtype = np.dtype(dtype)
+        # Scaling coefficients of the channels, known once grabbing started
+        self.scale_coeffs = None
+        self.allocate()
+
+    def allocate(self):
+        self.header = np.zeros(2, dtype=np.int64)
+        self.ts = np.zeros(2 * self.n_slots)
+        self.data = np.zeros((2 * self.n_slots, self.n_channels, self.samples_per_scan),
+                             dtype=self.dtype)
+
+    @property
+    def n_put(self):
+        return int(self.header[0])
+
+    def __len__(self):
+        return min(self.n_put, self.depth)
+
+    @property
+    def n_reserved(self):
+        return int(self.header[1])
+
+    def put(self, t, data):
+        slot = self.n_put % self.n_slots
+        self.header[1] = self.n_put + 1
+        for s in (slot, slot + self.n_slots):
+            self.ts[s] = t
+            self.data[s] = data
+        self.header[0] += 1
+
+    def put_many(self, ts, data):
+        n = len(ts)
+        if n > self.n_slots:
+            ts, data = ts[-self.n_slots:], data[-self.n_slots:]
+            self.header[0] += n - self.n_slots
+            n = self.n_slots
+        self.header[1] = self.n_put + n
+        # The block may wrap around the end of each half
+        start = self.n_put % self.n_slots
+        n_first = min(n, self.n_slots - start)
+        for offset in (0, self.n_slots):
+            self.ts[offset+start:offset+start+n_first] = ts[:n_first]
+            self.data[offset+start:offset+start+n_first] = data[:n_first]
+            self.ts[offset:offset+n-n_first] = ts[n_first:]
+            self.data[offset:offset+n-n_first] = data[n_first:]
+        self.header[0] += n
+
+    def snapshot(self, n=None):
+        """The latest (at most n, default depth) scans, oldest first"""
+        n_put = self.n_put
+        n = min(self.depth if n is None else n, n_put, self.depth)
+        stop = (n_put - 1) % self.n_slots + 1 + self.n_slots if n_put else 0
+        return LiveSnapshot(self, n_put, self.ts[stop-n:stop], self.data[stop-n:stop])
+
+
+class LiveSnapshot:
+    """The latest scans of a LiveScanBuffer at one moment, as views of the
+    buffer: ts (n,) and data (n, n_channels, samples_per_scan). The views
+    are overwritten once more than headroom new scans arrived, check
+    valid() after using them."""
+    def __init__(self, buffer, n_put, ts, data):
+        self.buffer = buffer
+        self.n_put = n_put
+        self.ts = ts
+        self.data = data
+
+    def __len__(self):
+        return len(self.ts)
+
+    def valid(self):
+        """True if no scan of the snapshot was overwritten so far"""
+        return self.buffer.n_reserved - self.n_put <= self.buffer.n_slots - len(self)
+
+    def scaled(self, channel, key=slice(None)):
+        """New array with the scans[key] of a channel in physical units"""
+        data = self.data[key, channel]
+        coeffs = self.buffer.scale_coeffs
+        if coeffs is None:
+            return np.array(data, dtype=np.float64)
+        return np.polynomial.polynomial.polyval(data, coeffs[channel])
+
+
+class ScanStatistics:
+    """Streaming mean and variance of every sample of the electrodes'
+    scans (Welford's algorithm, batches are merged with
+    fscv_reader.merge_statistics). They are accumulated in the stored units,
+    so scans written before the scaling coefficients are known count too,
+    and scaled when the file is closed."""
+    def __init__(self, n_electrodes, samples_per_scan):
+        self.n_scans = 0
+        self.mean = np.zeros((n_electrodes, samples_per_scan))
+        self.m2 = np.zeros((n_electrodes, samples_per_scan))
+
+    def add(self, scans):
+        """Add the scans (n_scans, n_electrodes, samples) of a batch"""
+        if len(scans) == 0:
+            return
+        scans = scans.astype(np.float64)
+        mean = scans.mean(0)
+        scans -= mean
+        self.n_scans, self.mean, self.m2 = fscv_reader.merge_statistics(
+                self.n_scans, self.mean, self.m2, len(scans), mean, (scans**2).sum(0))
+
+    def scaled(self, scale_coeffs=None):
+        """Mean and variance (like np.var) in physical units, given the
+        scaling coefficients of the electrodes. The scaling polynomial is
+        expanded around the mean: to second order for the mean (exact for
+        quadratic scaling), to first order for the variance."""
+        polynomial = np.polynomial.polynomial
+        mean = self.mean.copy()
+        var = self.m2 / max(self.n_scans, 1)
+        if scale_coeffs is not None:
+            for i, coeffs in enumerate(scale_coeffs):
+                slope = polynomial.polyval(mean[i], polynomial.polyder(coeffs))
+                curvature = polynomial.polyval(mean[i], polynomial.polyder(coeffs, 2))
+                mean[i] = polynomial.polyval(mean[i], coeffs) + curvature * var[i] / 2
+                var[i] *= slope**2
+        return mean, var
+
+
+class ScanFile:
+    """An h5 file with the arrays of a recording, or of one segment of it"""
+    def __init__(self, filename, n_electrodes, samples_per_scan, sample_format,
+                 scan_major, complevel, expectedrows, command_mode='full',
+                 command_threshold=0.05, command_keep_every=0, complib='blosc',
+                 shuffle='shuffle', scan_encoding='none', reference_every=100):
+        if command_mode not in COMMAND_MODES:
+            raise ValueError('Unknown command mode: %s' % command_mode)
+        if scan_encoding not in SCAN_ENCODINGS:
+            raise ValueError('Unknown scan encoding: %s' % scan_encoding)
+        if scan_encoding != 'none' and sample_format != 'int16':
+            raise ValueError('Scan encoding %s requires int16 samples' % scan_encoding)
+        self.filename = str(filename)
+        self.scan_major = scan_major
+        sample_atom = SAMPLE_ATOMS[sample_format]
+
+        # Scan-major files grow along the first axis: (n_scans, samples),
+        # otherwise along the last axis: (samples, n_scans)
+        if scan_major:
+            ts_shape = (0,)
+            scan_shape = (0, samples_per_scan)
+            chunkshape = scan_chunkshape(samples_per_scan, sample_atom.itemsize)
+        else:
+            ts_shape = (1, 0)
+            scan_shape = (samples_per_scan, 0)
+            chunkshape = None
+        # Invalid compression settings raise before the file is created
+        filters = make_filters(complevel, complib, shuffle)
+
+        self.fileh = tb.open_file(self.filename, mode='w')
+        # Array for timestanps
+        self.array_ts = self.fileh.create_earray(self.fileh.root,
+                                                 'array_ts',
+                                                 tb.FloatAtom(),
+                                                 ts_shape,
+                                                 "Times",
+                                                 expectedrows=expectedrows)
+
+        # Arrays for signal, one per electrode: array_scans, array_scans_1, ...
+        self.arrays_scans = []
+        for i in range(n_electrodes):
+            self.arrays_scans.append(
+                self.fileh.create_earray(self.fileh.root,
+                                         fscv_reader.scans_array_name(i),
+                                         sample_atom,
+                                         scan_shape,
+                                         "Scans electrode %i" % i if i else "Scans",
+                                         filters=filters,
+                                         expectedrows=expectedrows,
+                                         chunkshape=chunkshape))
+        self.array_scans = self.arrays_scans[0]
+        # Array for command voltage. In template mode it holds only the
+        # scans listed in array_command_index
+        self.command_mode = command_mode
+        self.array_command = self.fileh.create_earray(self.fileh.root,
+                                                      'array_command',
+                                                      sample_atom,
+                                                      scan_shape,
+                                                      "Command",
+                                                      filters=filters,
+                                                      expectedrows=expectedrows,
+                                                      chunkshape=chunkshape)
+        for array in self.arrays_scans + [self.array_command]:
+            array.attrs['sample_format'] = sample_format
+        self.array_command.attrs['command_mode'] = command_mode
+
+        # Delta encoding of the electrodes and the full command
+        self.encoders = {}
+        if scan_encoding != 'none':
+            encoded = list(self.arrays_scans)
+            if command_mode == 'full':
+                encoded.append(self.array_command)
+            for array in encoded:
+                array.attrs['scan_encoding'] = scan_encoding
+                array.attrs['reference_every'] = reference_every
+                references = None
+                if scan_encoding == 'reference':
+                    references = self.fileh.create_earray(self.fileh.root,
+                                                          array.name + '_reference',
+                                                          sample_atom,
+                                                          (0, samples_per_scan),
+                                                          "References of " + array.name,
+                                                          filters=filters)
+                self.encoders[array.name] = (DeltaEncoder(scan_encoding, reference_every),
+                                             references)
+
+        if command_mode == 'template':
+            self.command_threshold = command_threshold
+            self.command_keep_every = command_keep_every
+            self.command_template = None
+            # Volts per stored unit, for the deviation statistics
+            self.command_gain = 1.0
+            self.array_command.attrs['command_threshold'] = command_threshold
+            self.array_command.attrs['command_keep_every'] = command_keep_every
+            self.array_command_template = self.fileh.create_earray(self.fileh.root,
+                                                                   'array_command_template',
+                                                                   sample_atom,
+                                                                   (0, samples_per_scan),
+                                                                   "Command template")
+            self.array_command_index = self.fileh.create_earray(self.fileh.root,
+                                                                'array_command_index',
+                                                                tb.Int64Atom(),
+                                                                (0,),
+                                                                "Scans with stored command",
+                                                                filters=filters)
+            self.array_command_stats = self.fileh.create_earray(self.fileh.root,
+                                                                'array_command_stats',
+                                                                tb.Float64Atom(),
+                                                                (0, len(COMMAND_STATS_COLUMNS)),
+                                                                "Command deviation",
+                                                                filters=filters,
+                                                                expectedrows=expectedrows)
+            self.array_command_stats.attrs['columns'] = COMMAND_STATS_COLUMNS
+
+        # Per-scan timing information, see TIMING_COLUMNS
+        self.array_timing = self.fileh.create_earray(self.fileh.root,
+                                                     'array_timing',
+                                                     tb.Float64Atom(),
+                                                     (0, len(TIMING_COLUMNS)),
+                                                     "Timing",
+                                                     filters=filters,
+                                                     expectedrows=expectedrows)
+        self.array_timing.attrs['columns'] = TIMING_COLUMNS
+
+        # Gaps in the recorded scans, see GAP_COLUMNS
+        self.array_gaps = self.fileh.create_earray(self.fileh.root,
+                                                   'array_gaps',
+                                                   tb.Float64Atom(),
+                                                   (0, len(GAP_COLUMNS)),
+                                                   "Gaps")
+        self.array_gaps.attrs['columns'] = GAP_COLUMNS
+        self.array_gaps.attrs['kinds'] = GAP_KINDS
+
+        # Flush log, see FLUSH_COLUMNS
+        self.array_flushes = self.fileh.create_earray(self.fileh.root,
+                                                      'array_flushes',
+                                                      tb.Float64Atom(),
+                                                      (0, len(FLUSH_COLUMNS)),
+                                                      "Flushes")
+        self.array_flushes.attrs['columns'] = FLUSH_COLUMNS
+
+        self.set_attrs({'storage': 'hdf5', 'complevel': complevel, 'complib': complib,
+                        'shuffle': shuffle})
+
+        # Stored as array_stats_mean and array_stats_var when closed
+        self.statistics = ScanStatistics(n_electrodes, samples_per_scan)
+
+    def __len__(self):
+        return int(self.array_timing.nrows)
+
+    def set_attrs(self, attrs):
+        """Recording parameters are stored as attributes of array_ts"""
+        for name, value in attrs.items():
+            self.array_ts.attrs[name] = value
+
+    def set_scale_coeffs(self, scale_coeffs):
+        """Scaling coefficients of the channels: command, electrodes"""
+        for coeffs, array in zip(scale_coeffs, [self.array_command] + self.arrays_scans):
+            array.attrs['scale_coeffs'] = np.asarray(coeffs)
+        if self.command_mode == 'template' and len(scale_coeffs[0]) > 1:
+            self.command_gain = scale_coeffs[0][1]
+
+    def append(self, ts, data, timing, command_stats=None):
+        """Append scans (n_scans, channels, samples) with one append per array.
+        command_stats: deviation statistics of the command in template mode,
+        computed if None"""
+        self.array_timing.append(timing)
+        if self.command_mode == 'template':
+            self.append_command_deviation(data[:, 0], command_stats)
+        else:
+            self.append_scans(self.array_command, data[:, 0])
+        if self.scan_major:
+            self.array_ts.append(ts)
+        else:
+            self.array_ts.append(ts[np.newaxis])
+        for i, array in enumerate(self.arrays_scans):
+            self.append_scans(array, data[:, 1+i])
+        self.statistics.add(data[:, 1:])
+
+    def append_scans(self, array, scans):
+        """Append scans (n_scans, samples) in the layout of the file"""
+        if array.name in self.encoders:
+            encoder, references = self.encoders[array.name]
+            scans, new_references = encoder.encode(scans)
+            if new_references is not None and len(new_references):
+                references.append(new_references)
+        if self.scan_major:
+            array.append(scans)
+        else:
+            array.append(scans.T)
+
+    def append_command_deviation(self, command, stats=None):
+        """Template mode: store the deviation of the command scans from the
+        template and the full scans that deviate too much or are due for QA"""
+        if self.command_template is None:
+            self.array_command_template.append(command[:1])
+            self.command_template = command[0].astype(np.float64)
+
+        if stats is None:
+            deviation = (command - self.command_template) * self.command_gain
+            stats = np.column_stack([np.abs(deviation).max(1),
+                                     np.sqrt((deviation**2).mean(1)),
+                                     deviation.mean(1)])
+        index = self.array_command_stats.nrows + np.arange(len(command))
+        keep = stats[:, 0] > self.command_threshold
+        if self.command_keep_every > 0:
+            keep |= index % self.command_keep_every == 0
+
+        self.array_command_stats.append(stats)
+        if keep.any():
+            self.array_command_index.append(index[keep])
+            self.append_scans(self.array_command, command[keep])
+
+    def size_on_disk(self):
+        """Bytes of the compressed data written so far"""
+        references = [r for _, r in self.encoders.values() if r is not None]
+        return sum(array.size_on_disk
+                   for array in self.arrays_scans + [self.array_command] + references)
+
+    def flush(self, t=None):
+        """Flush to disk. With the time t the flush is logged in array_flushes."""
+        t_start = time.perf_counter()
+        self.fileh.flush()
+        duration = time.perf_counter() - t_start
+        if t is not None:
+            self.array_flushes.append([[t, duration, len(self)]])
+        return duration
+
+    def write_statistics(self):
+        if self.statistics.n_scans == 0:
+            return
+        scale_coeffs = None
+        if all('scale_coeffs' in array.attrs for array in self.arrays_scans):
+            scale_coeffs = [array.attrs['scale_coeffs'] for array in self.arrays_scans]
+        mean, var = self.statistics.scaled(scale_coeffs)
+        array_mean = self.fileh.create_array(self.fileh.root, 'array_stats_mean', mean,
+                                             "Mean of the scans")
+        array_mean.attrs['n_scans'] = self.statistics.n_scans
+        self.fileh.create_array(self.fileh.root, 'array_stats_var', var,
+                                "Variance of the scans")
+
+    def close(self):
+        self.write_statistics()
+        self.fileh.flush()
+        self.fileh.close()
+
+    def discard(self):
+        """Close and delete the file"""
+        self.close()
+        os.remove(self.filename)
+
+
+class EventLog:
+    """Event rows (gaps, flushes) of a NpyScanFile, stored in its metadata"""
+    def __init__(self, columns):
+        self.columns = columns
+        self.rows = []
+
+    @property
+    def nrows(self):
+        return len(self.rows)
+
+    def append(self, rows):
+        self.rows.extend(np.asarray(rows, dtype=np.float64).tolist())
+
+
+class NpyScanFile:
+    """A recording in the npy storage (see fscv_reader.NpyRecording), with
+    the interface of ScanFile.
+
+    The directory fscv_reader.npy_dirname(filename) gets one .npy segment
+    file per array for every segment_scans scans, preallocated and written
+    through a memory map, uncompressed and scan-major. metadata.json is
+    rewritten at every flush with the number of valid scans, so a crashed
+    recording is readable up to the last flush. The scans of the last
+    segment that are never written take no disk space on file systems with
+    sparse files. The compression and layout settings of ScanFile are
+    ignored; template commands and scan encodings are not supported."""
+    def __init__(self, filename, n_electrodes, samples_per_scan, sample_format,
+                 scan_major=True, complevel=0, expectedrows=0, command_mode='full',
+                 scan_encoding='none', segment_scans=None, **ignored):
+        if command_mode != 'full':
+            raise ValueError('The npy storage only stores the full command')
+        if scan_encoding != 'none':
+            raise ValueError('The npy storage does not support scan encodings')
+        self.filename = fscv_reader.npy_dirname(filename)
+        os.makedirs(self.filename, exist_ok=True)
+        self.n_electrodes = n_electrodes
+        dtype = SAMPLE_ATOMS[sample_format].dtype
+
+        # Arrays: (dtype, shape of one scan)
+        self.channel_names = fscv_reader.npy_channel_names(n_electrodes)
+        self.array_shapes = {'ts': (np.float64, ()),
+                             'timing': (np.float64, (len(TIMING_COLUMNS),))}
+        for name in self.channel_names:
+            self.array_shapes[name] = (dtype, (samples_per_scan,))
+        self.bytes_per_scan = sum(np.dtype(t).itemsize * int(np.prod(shape))
+                                  for t, shape in self.array_shapes.values())
+        if segment_scans is None:
+            segment_scans = max(1, NPY_SEGMENT_BYTES // self.bytes_per_scan)
+        self.segment_scans = segment_scans
+
+        # Memory maps of the segments of each array
+        self.segments = {name: [] for name in self.array_shapes}
+        self.n_scans = 0
+        self.n_flushed_segments = 0
+        self.channel_attrs = {name: {'sample_format': sample_format}
+                              for name in self.channel_names}
+        self.attrs = {'storage': 'npy'}
+        self.array_gaps = EventLog(GAP_COLUMNS)
+        self.array_flushes = EventLog(FLUSH_COLUMNS)
+        # Stored as stats_mean.npy and stats_var.npy when closed
+        self.statistics = ScanStatistics(n_electrodes, samples_per_scan)
+        self.metadata = {'n_electrodes': n_electrodes,
+                         'samples_per_scan': samples_per_scan,
+                         'sample_format': sample_format,
+                         'segment_scans': segment_scans,
+                         'timing_columns': TIMING_COLUMNS}
+
+        # Unscaled views of the written scans, like the arrays of ScanFile
+        self.fileh = None
+        self.array_ts = self.view('ts')
+        self.array_timing = self.view('timing')
+        self.array_command = self.view('command')
+        self.arrays_scans = [self.view(name) for name in self.channel_names[1:]]
+        self.array_scans = self.arrays_scans[0]
+        self.write_metadata()
+
+    def view(self, name):
+        dtype, scan_shape = self.array_shapes[name]
+        return fscv_reader.MemmapArray(self.segments[name], self.segment_scans, self.__len__,
+                                       dtype, scan_shape, self.channel_attrs.get(name),
+                                       scaled=False)
+
+    def __len__(self):
+        return self.n_scans
+
+    def set_attrs(self, attrs):
+        self.attrs.update(attrs)
+
+    def set_scale_coeffs(self, scale_coeffs):
+        """Scaling coefficients of the channels: command, electrodes"""
+        for coeffs, name in zip(scale_coeffs, self.channel_names):
+            self.channel_attrs[name]['scale_coeffs'] = np.asarray(coeffs).tolist()
+
+    def add_segment(self):
+        segment = len(self.segments['ts'])
+        for name, (dtype, scan_shape) in self.array_shapes.items():
+            self.segments[name].append(np.lib.format.open_memmap(
+                fscv_reader.npy_segment_filename(self.filename, name, segment), mode='w+',
+                dtype=dtype, shape=(self.segment_scans,) + scan_shape))
+
+    def append(self, ts, data, timing, command_stats=None):
+        """Append scans (n_scans, channels, samples). The scans are counted
+        once they are written to all arrays."""
+        i = 0
+        while i < len(ts):
+            segment, offset = divmod(self.n_scans + i, self.segment_scans)
+            if segment == len(self.segments['ts']):
+                self.add_segment()
+            n = min(len(ts) - i, self.segment_scans - offset)
+            self.segments['ts'][segment][offset:offset+n] = ts[i:i+n]
+            self.segments['timing'][segment][offset:offset+n] = timing[i:i+n]
+            for channel, name in enumerate(self.channel_names):
+                self.segments[name][segment][offset:offset+n] = data[i:i+n, channel]
+            i += n
+        self.n_scans += len(ts)
+        self.statistics.add(data[:, 1:])
+
+    def size_on_disk(self):
+        """Bytes of the scans written so far"""
+        return self.n_scans * self.bytes_per_scan
+
+    def write_metadata(self):
+        fscv_reader.write_json(os.path.join(self.filename, fscv_reader.NPY_METADATA),
+                               dict(self.metadata, format=fscv_reader.NPY_FORMAT,
+                                    n_scans=self.n_scans, channels=self.channel_attrs,
+                                    attrs=self.attrs,
+                                    gaps={'columns': GAP_COLUMNS, 'rows': self.array_gaps.rows},
+                                    flushes={'columns': FLUSH_COLUMNS,
+                                             'rows': self.array_flushes.rows}))
+
+    def flush(self, t=None):
+        """Flush the memory maps and write the metadata. With the time t the
+        flush is logged in the flush log."""
+        t_start = time.perf_counter()
+        n_scans = self.n_scans
+        for segments in self.segments.values():
+            for segment in segments[self.n_flushed_segments:]:
+                segment.flush()
+        # Completed segments are not written to any more
+        self.n_flushed_segments = max(0, len(self.segments['ts']) - 1)
+        duration = time.perf_counter() - t_start
+        if t is not None:
+            self.array_flushes.append([[t, duration, n_scans]])
+        self.write_metadata()
+        return duration
+
+    def write_statistics(self):
+        if self.statistics.n_scans == 0:
+            return
+        attrs = [self.channel_attrs[name] for name in self.channel_names[1:]]
+        scale_coeffs = None
+        if all('scale_coeffs' in a for a in attrs):
+            scale_coeffs = [a['scale_coeffs'] for a in attrs]
+        mean, var = self.statistics.scaled(scale_coeffs)
+        np.save(os.path.join(self.filename, 'stats_mean.npy'), mean)
+        np.save(os.path.join(self.filename, 'stats_var.npy'), var)
+        self.metadata['statistics_n_scans'] = self.statistics.n_scans
+
+    def close(self):
+        self.write_statistics()
+        self.flush()
+        for segments in self.segments.values():
+            segments.clear()
+
+    def discard(self):
+        """Close and delete the recording"""
+        self.close()
+        shutil.rmtree(self.filename)
+
+
+# Writers of the storages
+STORAGES = {'hdf5': ScanFile, 'npy': NpyScanFile}
 
 
 class NIGrabber:
     def __init__(self,
                  complevel = 5,
+                 complib = 'blosc',
+                 shuffle = 'shuffle',
+                 scan_encoding = 'none',
+                 reference_every = 100,
+                 compression_threads = 0,
+                 storage = 'hdf5',
                  expectedrows = 500,
                  samples_per_scan = 1000,
                  rate = 100e3,
                  filename = 'datafile.h5',
+                 queue_depth = 1000,
+                 batch_scans = 1,
+                 batch_period = 0,
+                 scan_major = False,
+                 sample_format = 'float64',
+                 scans_per_callback = 1,
+                 live_buffer = None,
+                 live_depth = 1000,
+                 n_electrodes = 1,
+                 backend = None,
+                 segment_bytes = 0,
+                 segment_duration = 0,
+                 flush_scans = 0,
+                 flush_period = 0,
+                 command_mode = 'full',
+                 command_threshold = 0.05,
+                 command_keep_every = 0,
                  ):
 
+        if sample_format not in SAMPLE_ATOMS:
+            raise ValueError('Unknown sample format: %s' % sample_format)
+
         self.samples_per_scan = samples_per_scan
         self.rate = rate
+        self.sample_format = sample_format
+
+        # Channel 0 records the command voltage, 1..N the currents of the N
+        # working electrodes
+        self.n_electrodes = n_electrodes
+        self.n_channels = 1 + n_electrodes
+        sample_atom = SAMPLE_ATOMS[sample_format]
+
+        # With one scan per callback each scan is triggered separately. With
+        # more, sampling is continuous after the first trigger and the
+        # callback gets blocks of scans_per_callback scans. Then the trigger
+        # period has to be samples_per_scan / rate and the timestamps are
+        # derived from the sample clock.
+        self.scans_per_callback = max(1, int(scans_per_callback))
+        self.samples_per_callback = self.samples_per_scan * self.scans_per_callback
+        self.scan_offsets = np.arange(self.scans_per_callback) * self.samples_per_scan / rate
+        # Timing of the scans of a block, the trigger interval is the scan period
+        self.block_timing = np.zeros((self.scans_per_callback, len(TIMING_COLUMNS)))
+        self.block_timing[:, 3] = self.samples_per_scan / rate
         self.n_scans_acquired = 0
+        self.n_scans_written = 0
         self.running = False
 
+        # Scans are handed from the DAQ callback to the writer thread via a
+        # ring buffer, so a slow disk or compressor never blocks the callback
+        self.queue_depth = queue_depth
+        self.ring = ScanRingBuffer(queue_depth, self.n_channels, samples_per_scan,
+                                   dtype=sample_atom.dtype)
+        self.writing = False
+        self.writer_thread = None
+
+        # Every scan is also copied into the live buffer, which holds the
+        # latest live_depth scans for the display (see snapshot), so the GUI
+        # never reads the file that is being written. It can be given, e.g.
+        # a fscv_process.SharedScanRing to publish the scans to the GUI process
+        if live_buffer is None:
+            live_buffer = LiveScanBuffer(live_depth, self.n_channels, samples_per_scan,
+                                         dtype=sample_atom.dtype)
+        self.live_buffer = live_buffer
+
+        # Source of the scans, see fscv_backends. By default the NI DAQ, or
+        # the simulator if nidaqmx is not installed
+        if backend is None:
+            backend = fscv_backends.default_backend()
+        self.backend = backend
+        self.backend.configure(self.n_channels, samples_per_scan, self.scans_per_callback,
+                               rate, sample_format)
+
+        # The writer appends up to batch_scans scans in one call per array.
+        # An incomplete batch is written once its first scan is older than
+        # batch_period seconds (0: wait for a complete batch)
+        self.batch_scans = max(1, min(batch_scans, queue_depth))
+        self.batch_period = batch_period
+
         self.delta_t_max = None
         self.delta_t_min = None
         self.delta_t = None
 
-        self.fileh = tb.open_file(filename, mode='w')
-        # Array for timestanps
-        self.array_ts = self.fileh.create_earray(self.fileh.root,
-                                                 'array_ts',
-                                                 tb.FloatAtom(),
-                                                 (1, 0),
-                                                 "Times",
-                                                 expectedrows=expectedrows)
+        # Files are created with these settings, see ScanFile
+        if storage not in STORAGES:
+            raise ValueError('Unknown storage: %s' % storage)
+        self.storage = storage
+        self.file_class = STORAGES[storage]
+        self.scan_major = scan_major
+        self.file_kwargs = dict(n_electrodes=n_electrodes,
+                                samples_per_scan=samples_per_scan,
+                                sample_format=sample_format,
+                                scan_major=scan_major,
+                                complevel=complevel,
+                                complib=complib,
+                                shuffle=shuffle,
+                                scan_encoding=scan_encoding,
+                                reference_every=reference_every,
+                                expectedrows=expectedrows,
+                                command_mode=command_mode,
+                                command_threshold=command_threshold,
+                                command_keep_every=command_keep_every)
+        # Recording parameters, stored in every file
+        self.file_attrs = {'n_electrodes': self.n_electrodes,
+                           'backend': self.backend.name,
+                           'scans_per_callback': self.scans_per_callback,
+                           'ts_source': ('perf_counter' if self.scans_per_callback == 1
+                                         else 'sample_clock')}
+        self.scale_coeffs = None
 
-        # Array for signal
-        filters = tb.Filters(complevel=complevel, complib='blosc')
-        self.array_scans = self.fileh.create_earray(self.fileh.root,
-                                                    'array_scans',
-                                                    tb.FloatAtom(),
-                                                    (self.samples_per_scan, 0),
-                                                    "Scans", filters=filters,
-                                                    expectedrows=expectedrows)
-        # Array for command voltage
-        self.array_command = self.fileh.create_earray(self.fileh.root,
-                                                      'array_command',
-                                                      tb.FloatAtom(),
-                                                      (self.samples_per_scan, 0),
-                                                      "Command",
-                                                      filters=filters,
-                                                      expectedrows=expectedrows)
+        # Blosc compresses the blocks of a chunk in parallel with up to this
+        # many threads (0: tables.parameters.MAX_BLOSC_THREADS). The setting
+        # is global for the process and does not change the file format
+        self.compression_threads = compression_threads
+        if compression_threads:
+            self.file_attrs['compression_threads'] = compression_threads
 
-    def callback(self, task_handle, every_n_samples_event_type,
-                number_of_samples, callback_data):
-        if REAL_DATA:
-            data = np.array(self.task.read(number_of_samples_per_channel=self.samples_per_scan))
+        # With a segment size [bytes] or duration [s] the recording rolls
+        # over to the next segment file when one of them is reached. The
+        # segments are listed in a manifest, see fscv_reader. The next
+        # segment is created in advance, when SEGMENT_PREPARE_FILL of the
+        # current one is reached, so the switch itself is quick.
+        self.filename = str(filename)
+        self.segment_bytes = segment_bytes
+        self.segment_duration = segment_duration
+        self.segmented = segment_bytes > 0 or segment_duration > 0
+        self.segments = []
+        self.segment_t0 = None
+        self.next_file = None
+        if self.segmented:
+            self.data_file = self.create_segment()
         else:
-            data = np.random.normal(size=(2, self.samples_per_scan))
-            data[1,:50] +=5
+            self.data_file = self.file_class(self.filename, **self.file_kwargs)
+            self.data_file.set_attrs(self.file_attrs)
+        self.use_file(self.data_file)
+
+        self.recent_intervals = np.full(N_RECENT_INTERVALS, np.nan)
+
+        # The writer flushes the file every flush_scans scans or every
+        # flush_period seconds (0: never, only at the end). The DAQ callback
+        # never flushes.
+        self.flush_scans = flush_scans
+        self.flush_period = flush_period
+        self.last_flush_time = 0
+        self.last_flush_scans = 0
+        self.next_flush_allowed = 0
+        self.n_flushes = 0
+        self.flush_duration_max = 0
 
+        # Gaps in the recorded scans, see GAP_COLUMNS. The callback collects
+        # them in a list, the writer appends them to the file
+        self.gap_events = []
+        self.gap_lock = threading.Lock()
+        self.n_gaps_written = 0
+        self.n_scans_dropped = 0
+        self.n_scans_read = 0
+
+    def callback(self):
+        """Called by the backend for every block of scans_per_callback scans"""
         if not self.running:
-            return 0
+            # Stopping, scans that are not read any more are recorded as an
+            # 'unread' gap
+            return
+        t_entry = time.perf_counter()
+        n_scans = self.scans_per_callback
+        data = self.backend.read_block(self.read_buffer)
+        read_duration = time.perf_counter() - t_entry
+        if data is None:
+            return
+
+        t_now = t_entry - self.t0
 
-        t_now = time.perf_counter() - self.t0
-        # Append new data to data storage
-        self.array_ts.append(np.array([t_now])[np.newaxis])
-        self.array_command.append(data[0][:, np.newaxis])
-        self.array_scans.append(data[1][:, np.newaxis])
+        # Compare the sample counter of the source with the scans read so far
+        first_scan = self.source_scan_index()
+        if first_scan > self.n_scans_read:
+            self.record_gap(first_scan - self.n_scans_read, 'counter', t_now)
+        self.n_scans_read = first_scan + n_scans
+        # Hand new data over to the writer thread
+        if n_scans == 1:
+            interval = t_now - self.lastUpdate if self.n_scans_acquired else np.nan
+            if not self.ring.put(t_now, data, (t_now, read_duration, 0, interval)):
+                self.record_gap(1, 'overflow', t_now)
+            self.live_buffer.put(t_now, data)
+            self.recent_intervals[self.n_scans_acquired % N_RECENT_INTERVALS] = interval
+        else:
+            # Split the block into scans (no copy) and time them by the
+            # sample clock: the first sample was acquired at t=0. The scan
+            # index comes from the sample counter, so the timestamps stay
+            # right after lost scans
+            scans = data.reshape(data.shape[0], n_scans, self.samples_per_scan).swapaxes(0, 1)
+            ts = first_scan * self.samples_per_scan / self.rate + self.scan_offsets
+            timing = self.block_timing
+            timing[:, 0] = t_now
+            timing[:, 1] = read_duration
+            n_queued = self.ring.put_many(ts, scans, timing)
+            if n_queued < n_scans:
+                self.record_gap(n_scans - n_queued, 'overflow', t_now)
+            self.live_buffer.put_many(ts, scans)
+            # The sample clock intervals are constant, show the callback jitter
+            if self.n_scans_acquired:
+                i = self.n_scans_acquired // n_scans % N_RECENT_INTERVALS
+                self.recent_intervals[i] = (t_now - self.lastUpdate) / n_scans
 
-        self.n_scans_acquired += 1
+        self.n_scans_acquired += n_scans
 
 
-        if self.n_scans_acquired > 1:
-            self.delta_t = t_now - self.lastUpdate
+        if self.n_scans_acquired > n_scans:
+            # Mean scan period since the last callback
+            self.delta_t = (t_now - self.lastUpdate) / n_scans
 
-        if self.n_scans_acquired == 2:
+        if self.n_scans_acquired == 2*n_scans:
                self.delta_t_max = self.delta_t
                self.delta_t_min = self.delta_t
-        elif self.n_scans_acquired > 2:
+        elif self.n_scans_acquired > 2*n_scans:
             if self.delta_t > self.delta_t_max:
                self.delta_t_max = self.delta_t
             if self.delta_t < self.delta_t_min:
@@ -90,82 +1033,268 @@ class NIGrabber:
 
         self.lastUpdate = t_now
 
-        return 0
+    def source_scan_index(self):
+        """Index of the first scan of the block just read, according to the
+        sample counter of the backend"""
+        return self.backend.n_scans_read - self.scans_per_callback
 
-    def start_grabbing(self):
-        self.running = True
-        self.n_scans_acquired = 0
+    def record_gap(self, n_missing, kind, t):
+        """Called from the callback, the writer stores the gap in the file.
+        Consecutive gaps of the same kind are merged into one event."""
+        event = [self.ring.n_put, n_missing, t, GAP_KINDS.index(kind)]
+        with self.gap_lock:
+            if (len(self.gap_events) > self.n_gaps_written
+                    and self.gap_events[-1][0] == event[0]
+                    and self.gap_events[-1][3] == event[3]):
+                self.gap_events[-1][1] += n_missing
+            else:
+                self.gap_events.append(event)
+        self.n_scans_dropped += n_missing
+
+    def write_gaps(self):
+        if len(self.gap_events) > self.n_gaps_written:
+            with self.gap_lock:
+                events = np.array(self.gap_events[self.n_gaps_written:])
+                self.n_gaps_written = len(self.gap_events)
+            self.array_gaps.append(events)
+
+    @property
+    def interval_histogram(self):
+        """Histogram (counts, bin edges) of the recent trigger intervals"""
+        intervals = self.recent_intervals[np.isfinite(self.recent_intervals)]
+        if len(intervals) == 0:
+            return None
+        return np.histogram(intervals, bins=50)
+
+    def use_file(self, data_file):
+        """Write to data_file from now on"""
+        self.data_file = data_file
+        self.fileh = data_file.fileh
+        self.array_ts = data_file.array_ts
+        self.arrays_scans = data_file.arrays_scans
+        self.array_scans = data_file.array_scans
+        self.array_command = data_file.array_command
+        self.array_timing = data_file.array_timing
+        self.array_gaps = data_file.array_gaps
+
+    def set_attrs(self, attrs):
+        """Store recording parameters as attributes of array_ts"""
+        self.file_attrs.update(attrs)
+        with fscv_reader.TABLES_LOCK:
+            self.data_file.set_attrs(attrs)
+
+    def create_segment(self):
+        """Create the file of the next segment and add it to the manifest"""
+        filename = fscv_reader.segment_filename(self.filename, len(self.segments))
+        data_file = self.file_class(filename, **self.file_kwargs)
+        data_file.set_attrs(dict(self.file_attrs, segment=len(self.segments)))
+        if self.scale_coeffs is not None:
+            data_file.set_scale_coeffs(self.scale_coeffs)
+        # first_scan is known when the segment is used, n_scans when it is full
+        self.segments.append({'filename': os.path.basename(data_file.filename),
+                              'first_scan': 0 if len(self.segments) == 0 else None,
+                              'n_scans': None})
+        return data_file
 
-        if REAL_DATA:
-            self.task = nidaqmx.Task()
+    def write_manifest(self, complete=False):
+        fscv_reader.write_manifest(fscv_reader.manifest_filename(self.filename),
+                                   {'segments': self.segments, 'complete': complete})
 
-            min_val = -10
-            max_val = 10
-            self.task.ai_channels.add_ai_voltage_chan("PXI1Slot4_2/ai0:1", min_val=min_val, max_val=max_val)
+    def check_rollover(self, t):
+        """Called by the writer before a batch whose first scan is at t"""
+        if self.segment_t0 is None:
+            self.segment_t0 = t
+            return
 
-            #self.task.timing.cfg_samp_clk_timing(1000, sample_mode=AcquisitionType.CONTINUOUS)
-            self.task.timing.cfg_samp_clk_timing(rate=self.rate,
-                                                 sample_mode=AcquisitionType.FINITE,
-                                                 samps_per_chan=self.samples_per_scan)
+        fill = 0
+        if self.segment_bytes > 0:
+            fill = self.data_file.size_on_disk() / self.segment_bytes
+        if self.segment_duration > 0:
+            fill = max(fill, (t - self.segment_t0) / self.segment_duration)
 
-            self.task.register_every_n_samples_acquired_into_buffer_event(
-                self.samples_per_scan, self.callback)
+        if fill >= SEGMENT_PREPARE_FILL and self.next_file is None:
+            self.next_file = self.create_segment()
+        if fill >= 1:
+            self.roll_over(t)
 
-            self.task.triggers.start_trigger.cfg_dig_edge_start_trig(
-                "/PXI1Slot4_2/PFI0")
+    def roll_over(self, t):
+        """Switch to the prepared next segment and close the finished one"""
+        self.segments[-2]['n_scans'] = len(self.data_file)
+        self.segments[-1]['first_scan'] = self.n_scans_written
+        self.data_file.flush(t)
+        self.data_file.close()
+        self.use_file(self.next_file)
+        self.next_file = None
+        self.segment_t0 = t
+        self.write_manifest()
 
-            self.task.triggers.start_trigger.retriggerable = True
+    def snapshot(self, n=None):
+        """The latest (at most n) scans of all channels without copying, see
+        LiveSnapshot. Channel 0 is the command, 1..N the electrodes."""
+        return self.live_buffer.snapshot(n)
 
+    @property
+    def queue_length(self):
+        """Number of scans waiting to be written"""
+        return len(self.ring)
 
+    @property
+    def queue_high_water(self):
+        """Maximum number of scans that were waiting to be written"""
+        return self.ring.high_water
+
+    @property
+    def write_latency(self):
+        """Age [s] of the oldest scan waiting to be written"""
+        if len(self.ring) == 0:
+            return 0.0
+        return time.perf_counter() - self.t0 - self.ring.oldest_ts()
+
+    @property
+    def n_scans_overflow(self):
+        """Number of scans dropped because the write queue was full"""
+        return self.ring.n_overflow
+
+    def write_loop(self):
+        """Writer thread: drains the ring buffer into the h5 file in batches"""
+        timeout = 0.1
+        while True:
+            n_queued = self.ring.wait(self.batch_scans, timeout)
+            timeout = 0.1
+            if n_queued == 0:
+                if not self.writing:
+                    # Stopped and everything is written
+                    break
+                continue
+
+            if n_queued < self.batch_scans and self.writing:
+                # Incomplete batch, only written if it waited long enough
+                if self.batch_period <= 0:
+                    continue
+                age = time.perf_counter() - self.t0 - self.ring.oldest_ts()
+                if age < self.batch_period:
+                    timeout = self.batch_period - age
+                    continue
+
+            self.write_batch(self.batch_scans)
+
+    def write_batch(self, n):
+        """Append up to n queued scans with a single append per array"""
+        ts, data, timing = self.ring.peek(n)
+        # A replay backend reads its recording on the clock thread
+        with fscv_reader.TABLES_LOCK:
+            if self.segmented:
+                self.check_rollover(ts[0])
+            self.write_gaps()
+            self.data_file.append(ts, data, timing)
+            self.ring.release(len(ts))
+            self.n_scans_written += len(ts)
+            self.check_flush()
+
+    def check_flush(self):
+        """Flush if the flush policy asks for it, called by the writer"""
+        if self.flush_scans <= 0 and self.flush_period <= 0:
+            return
+        t = time.perf_counter() - self.t0
+        due = ((self.flush_scans > 0
+                and self.n_scans_written - self.last_flush_scans >= self.flush_scans)
+               or (self.flush_period > 0 and t - self.last_flush_time >= self.flush_period))
+        if not due or t < self.next_flush_allowed:
+            return
+
+        duration = self.data_file.flush(t)
+        self.last_flush_time = t
+        self.last_flush_scans = self.n_scans_written
+        self.next_flush_allowed = t + duration / FLUSH_MAX_DUTY
+        self.n_flushes += 1
+        self.flush_duration_max = max(self.flush_duration_max, duration)
+
+    def start_grabbing(self):
+        self.running = True
+        self.n_scans_acquired = 0
+        self.n_scans_read = 0
+
+        # Set on every start, an earlier recording of the process may have
+        # changed it
+        tb.set_blosc_max_threads(self.compression_threads
+                                 or tb.parameters.MAX_BLOSC_THREADS)
+
+        # Scans are read into this buffer, it is reused for every callback
+        if self.sample_format == 'int16':
+            self.read_buffer = np.zeros((self.n_channels, self.samples_per_callback),
+                                        dtype=np.int16)
         else:
-            class phantom_data_task:
-                """Single use phantom data generator."""
-                def __init__(self, callback_function, acuisition_period_sec=0.1):
-                    self.callback_function = callback_function
-                    self.acuisition_period_sec = acuisition_period_sec
-                    self.generate = True
-
-                def acquire_random_data(self):
-                    """ This  continously calls the callback function """
-                    while self.generate:
-                        time.sleep(self.acuisition_period_sec)
-                        if self.generate:
-                            self.callback_function(None, None, None, None)
-
-                def close(self):
-                    """ Stop calling the callback function """
-                    self.generate=False
-
-            task_phantom = phantom_data_task(callback_function=self.callback,
-                                             acuisition_period_sec=self.samples_per_scan/self.rate)
-
-            phantom_thread = threading.Thread(target=task_phantom.acquire_random_data)
-            self.task_phantom = task_phantom
-            self.task = phantom_thread
+            self.read_buffer = np.zeros((self.n_channels, self.samples_per_callback))
 
-        # Save start time
-        self.array_ts.attrs['start_time'] = time.time()
-        self.array_ts.attrs['start_time_str'] = time.ctime()
+        # Start grabbing. The scaling coefficients are known once the
+        # backend is started, before the first block is read. The callback
+        # only queues the scans; the writer thread is started after the
+        # attributes are stored, so the file is used by one thread at a time
         self.t0 = time.perf_counter()
+        try:
+            self.backend.start(self.callback)
+        except Exception:
+            # Nothing was recorded, the file is removed
+            self.running = False
+            self.data_file.discard()
+            raise
+
+        self.scale_coeffs = self.backend.scale_coeffs
+        with fscv_reader.TABLES_LOCK:
+            if self.scale_coeffs is not None:
+                self.data_file.set_scale_coeffs(self.scale_coeffs)
+        self.live_buffer.scale_coeffs = self.scale_coeffs
 
-        # Start grabbing
-        self.task.start()
+        # Save start time
+        self.set_attrs({'start_time': time.time(), 'start_time_str': time.ctime()})
+        if self.segmented:
+            self.segment_t0 = None
+            self.write_manifest()
 
+        self.writing = True
+        self.writer_thread = threading.Thread(target=self.write_loop)
+        self.writer_thread.start()
 
     def stop_grab(self):
         self.running = False
 
-        this_filename = str(self.fileh.filename)
-        self.fileh.flush()
-        self.fileh.close()
-        print('saved: ', self.fileh.filename)
+        self.backend.stop()
 
-        if REAL_DATA:
-            self.task.close()
-        else:
-            self.task_phantom.close()
+        # Scans that the backend acquired but that were never read
+        n_available = self.backend.n_scans_available
+        if n_available > self.n_scans_read:
+            self.record_gap(n_available - self.n_scans_read, 'unread',
+                            time.perf_counter() - self.t0)
+
+        # Let the writer thread write the remaining scans, including the
+        # final incomplete batch
+        self.writing = False
+        if self.writer_thread is not None:
+            self.writer_thread.join()
+        while len(self.ring):
+            self.write_batch(self.batch_scans)
+        self.write_gaps()
+        if self.n_scans_overflow:
+            print('Write queue overflow, scans dropped: ', self.n_scans_overflow)
+        if self.n_scans_dropped:
+            print('Gaps: %i, scans dropped: %i' % (len(self.gap_events), self.n_scans_dropped))
+
+        self.data_file.flush(time.perf_counter() - self.t0)
+        n_scans_segment = len(self.data_file)
+        self.data_file.close()
+        if not self.segmented:
+            print('saved: ', self.data_file.filename)
+            return self.data_file.filename
 
-        return this_filename
+        # A prepared segment that got no scans is removed
+        if self.next_file is not None:
+            self.next_file.discard()
+            self.segments.pop()
+        self.segments[-1]['n_scans'] = n_scans_segment
+        self.write_manifest(complete=True)
+        manifest_filename = fscv_reader.manifest_filename(self.filename)
+        print('saved: %s (%i segments)' % (manifest_filename, len(self.segments)))
+        return manifest_filename
 
 class MyGui:
     def __init__(self, grabber):
@@ -179,6 +1308,7 @@ class MyGui:
         print(self.grabber.delta_t_min)
         print(self.grabber.delta_t)
         print(self.grabber.delta_t_max)
+        print('Queue high water: ', self.grabber.queue_high_water)
 
         self.grabber.stop_grab()
 
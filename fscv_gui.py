@@ -4,8 +4,8 @@ import sys
 import time
 from pathlib import Path
 import configparser
+import pickle
 import numpy as np
-import tables as tb
 
 import pyqtgraph as pg
 import pyqtgraph.dockarea as pqda
@@ -19,14 +19,13 @@ try:
 except ModuleNotFoundError:
     AGILENT_CONNECTED = False
 
-try:
-    from ecu import ECUManager
-    VALVES_CONNECTED = True
-except ModuleNotFoundError:
-    VALVES_CONNECTED = False
-
 import labtools
 import fscv_daq
+import fscv_reader
+import fscv_process
+import fscv_backends
+import fscv_valves
+import fscv_background
 
 NO_SYMPHONY_NAME = "None"
 space = " "*20
@@ -34,7 +33,33 @@ lspace = " "*40
 STOP_BTN_NAME = lspace+"Stop"+lspace
 START_BTN_NAME = lspace+"Start"+lspace
 START_BACKGROUND_BTN_NAME = space+"Measure background"+space
-FINAL_CHORD = "final_chord"
+FINAL_CHORD = fscv_valves.FINAL_CHORD
+
+class WaterfallImage:
+    """Rolling image of the latest n_scans scans for the waterfall plot.
+
+    Only the scans acquired since the previous update are added, so the
+    cost of an update does not grow with the length of the recording. Each
+    scan is written twice (row and row + n_scans), the latest n_scans rows
+    are one contiguous view (image)."""
+    def __init__(self, n_scans, samples_per_scan):
+        self.n_scans = n_scans
+        self.rows = np.zeros((2 * n_scans, samples_per_scan))
+        self.n_added = 0
+
+    @property
+    def image(self):
+        start = self.n_added % self.n_scans
+        return self.rows[start:start+self.n_scans]
+
+    def add(self, scans):
+        """Add scans (n, samples), only the last n_scans are kept"""
+        scans = scans[-self.n_scans:]
+        rows = (self.n_added + np.arange(len(scans))) % self.n_scans
+        self.rows[rows] = scans
+        self.rows[rows + self.n_scans] = scans
+        self.n_added += len(scans)
+
 
 class FscvWin(QtWidgets.QMainWindow):
     """Main window for the FSCV measurement"""
@@ -50,34 +75,15 @@ class FscvWin(QtWidgets.QMainWindow):
 
         # Connect to Function generator
         self.background_current = None
+        self.background_engine = None
+        self.background_events = []
+        self.waterfall = None
         if AGILENT_CONNECTED:
             self.function_generator = Agilent33220A(
                 'USB0::0x0957::0x0407::MY43004373::INSTR')
 
         # Connect to valves
-        if VALVES_CONNECTED:
-            self.ecu_manager = ECUManager()
-            for state, ecu in enumerate(self.ecu_manager.get_all()):
-                print('Connected: ', ecu)#, "UUID: ",ecu.uuid)
-
-            self.ecus = [None, None, None, None]
-            ecu_errors = []
-            for i in range(4):
-                try:
-                    self.ecus[i] = self.ecu_manager.get_by_uuid(
-                                                    self.ecu_config['ECU_%i'%(i+1)])
-                    print("Identified ecu position %i"%(i+1), self.ecus[i])
-                except KeyError:
-                    print("Ecu position %i not configured"%(i+1))
-                except ValueError as e:
-                    ecu_error = "Ecu %s not connected"%self.ecu_config['ECU_%i' % (i + 1)]
-                    print(ecu_error)
-                    ecu_errors.append(ecu_error)
-            if ecu_errors != []:
-                #pg.QtGui.QMessageBox.critical(self, "Valve ECU connection error", str(ecu_errors))
-                print("Valve ECU connection error", str(ecu_errors))
-
-
+        self.valves = fscv_valves.ValveController(self.ecu_config)
 
         # Build Gui
         #QtGui.QMainWindow.__init__(self)
@@ -87,15 +93,11 @@ class FscvWin(QtWidgets.QMainWindow):
         self.resize(1200, 800)
         self.setWindowTitle('FSCV')
         control_gui_element = pqda.Dock("Control", size=(250, 600))
-        current_view_gui_element = pqda.Dock("Scan view", size=(500, 400))
-        command_view_gui_element = pqda.Dock("Command view", size=(500, 400))
-        duck_view_gui_element = pqda.Dock("Duck view", size=(500, 400))
+        current_view_gui_element = pqda.Dock("Scan view", size=(500, 1200))
         image_view_gui_element = pqda.Dock("Image view", size=(500, 400))
         area.addDock(control_gui_element)
         area.addDock(current_view_gui_element, 'right', control_gui_element)
-        area.addDock(command_view_gui_element, 'bottom', current_view_gui_element)
-        area.addDock(duck_view_gui_element, 'bottom', command_view_gui_element)
-        area.addDock(image_view_gui_element, 'bottom', duck_view_gui_element)
+        area.addDock(image_view_gui_element, 'bottom', current_view_gui_element)
 
         # Configuration and Controll is done with a Parameter Tree object.
         gui_parameter_dict = [
@@ -112,6 +114,15 @@ class FscvWin(QtWidgets.QMainWindow):
                 # 'siPrefix': True, 'suffix': 's'},
                 {'name': 'Sampling rate', 'type': 'float', 'value': 100e3, 'siPrefix': True, 'suffix': 'Hz'},
                 {'name': 'Samples per scan', 'type': 'int', 'value': 1000},
+                {'name': 'Scans per callback', 'type': 'int', 'value': 1, 'limits': (1, 1e3)},
+                {'name': 'Electrodes', 'type': 'int', 'value': 1, 'limits': (1, 8)},
+                {'name': 'Data source', 'type': 'list', 'values': list(fscv_backends.BACKENDS),
+                        'value': 'nidaqmx' if fscv_backends.NIDAQMX_AVAILABLE else 'simulator'},
+                {'name': 'Replay file', 'type': 'str', 'value': ''},
+                {'name': 'Max speed', 'type': 'bool', 'value': False},
+                {'name': 'Separate acquisition process', 'type': 'bool',
+                        'value': False,
+                        'enabled': fscv_process.SHARED_MEMORY_AVAILABLE},
                 #{'name': 'Line scan period', 'type': 'float', 'value': 0.1, 'siPrefix': True, 'suffix': 's'},
             ]},
             {'name': 'Run', 'type': 'group', 'children': [
@@ -129,9 +140,19 @@ class FscvWin(QtWidgets.QMainWindow):
                 {'name': 'Waterfall update period', 'type': 'float', 'value': 0.3,
                          'siPrefix': True, 'suffix': 's', 'limits':(0.05, 1e2)},
                 {'name': 'Waterfall n scans', 'type': 'int', 'value': 600, 'limits':(1, 1e4)},
-                {'name': 'Live background subtraction', 'type': 'bool', 'value': False, 'readonly': True},
+                {'name': 'Displayed electrode', 'type': 'int', 'value': 0, 'limits': (0, 7)},
+                {'name': 'Command plot threshold', 'type': 'float', 'value': 1e-3,
+                         'siPrefix': True, 'suffix': 'V', 'limits': (0, 20)},
+                {'name': 'Live background subtraction', 'type': 'bool', 'value': False},
+                {'name': 'Background mode', 'type': 'list',
+                         'values': fscv_background.BACKGROUND_MODES, 'value': 'file'},
+                {'name': 'Background scans', 'type': 'int', 'value': 50, 'limits': (1, 1e4)},
+                {'name': 'Mark background', 'type': 'action'},
                 {'name': 'Background file', 'type': 'str', 'value': 'None', 'readonly': True},
+                {'name': 'Background noise', 'type': 'float', 'value': 0, 'readonly': True,
+                         'siPrefix': True, 'suffix': 'V'},
                 {'name': 'Load background', 'type': 'action'},
+                {'name': 'Preview every', 'type': 'int', 'value': 10, 'limits': (0, 1e6)},
 
             ]},
             {'name': 'Monitor', 'type': 'group', 'children': [
@@ -142,14 +163,59 @@ class FscvWin(QtWidgets.QMainWindow):
                  'readonly': True},
                 {'name': 'Aquisition period max', 'type': 'float', 'value': 0, 'siPrefix': True, 'suffix': 's',
                  'readonly': True},
+                {'name': 'Write queue', 'type': 'int', 'value': 0, 'readonly': True},
+                {'name': 'Write queue max', 'type': 'int', 'value': 0, 'readonly': True},
+                {'name': 'Write queue overflow', 'type': 'int', 'value': 0, 'readonly': True},
+                {'name': 'Dropped scans', 'type': 'int', 'value': 0, 'readonly': True},
+                {'name': 'Flushes', 'type': 'int', 'value': 0, 'readonly': True},
+                {'name': 'Flush duration max', 'type': 'float', 'value': 0, 'siPrefix': True,
+                        'suffix': 's', 'readonly': True},
+                {'name': 'Preview skipped scans', 'type': 'int', 'value': 0, 'readonly': True},
+                {'name': 'Plot message size', 'type': 'int', 'value': 0, 'suffix': 'B',
+                        'readonly': True},
+                {'name': 'Plot latency', 'type': 'float', 'value': 0, 'siPrefix': True,
+                        'suffix': 's', 'readonly': True},
+                {'name': 'Plot latency max', 'type': 'float', 'value': 0, 'siPrefix': True,
+                        'suffix': 's', 'readonly': True},
             ]},
             {'name': 'Data storage', 'type': 'group', 'children': [
                 {'name': 'Data path', 'type': 'str', 'value': self.datapath.absolute().as_posix(),
                  'readonly': True},
                 {'name': 'Data file', 'type': 'str', 'value': '',
                  'readonly': True},
+                {'name': 'Storage', 'type': 'list', 'values': fscv_daq.STORAGE_NAMES,
+                        'value': 'hdf5'},
                 {'name': 'Blosc compression level', 'type': 'int', 'value': 5,
                         'limits': (0, 9)},
+                {'name': 'Compression library', 'type': 'list', 'values': fscv_daq.COMPLIBS,
+                        'value': 'blosc'},
+                {'name': 'Shuffle', 'type': 'list', 'values': fscv_daq.SHUFFLE_MODES,
+                        'value': 'shuffle'},
+                {'name': 'Scan encoding', 'type': 'list', 'values': fscv_daq.SCAN_ENCODINGS,
+                        'value': 'none'},
+                {'name': 'Reference every', 'type': 'int', 'value': 100, 'limits': (1, 1e6)},
+                {'name': 'Compression threads', 'type': 'int', 'value': 0, 'limits': (0, 256)},
+                {'name': 'Write queue depth', 'type': 'int', 'value': 1000,
+                        'limits': (1, 1e6)},
+                {'name': 'Write batch scans', 'type': 'int', 'value': 10,
+                        'limits': (1, 1e4)},
+                {'name': 'Write batch period', 'type': 'float', 'value': 0.5,
+                        'siPrefix': True, 'suffix': 's', 'limits': (0, 1e2)},
+                {'name': 'Scan major layout', 'type': 'bool', 'value': True},
+                {'name': 'Sample format', 'type': 'list', 'values': list(fscv_daq.SAMPLE_ATOMS),
+                        'value': 'float64'},
+                {'name': 'Segment size', 'type': 'float', 'value': 0, 'siPrefix': True,
+                        'suffix': 'B', 'limits': (0, 1e12)},
+                {'name': 'Segment duration', 'type': 'float', 'value': 0, 'siPrefix': True,
+                        'suffix': 's', 'limits': (0, 1e6)},
+                {'name': 'Flush period', 'type': 'float', 'value': 5, 'siPrefix': True,
+                        'suffix': 's', 'limits': (0, 1e4)},
+                {'name': 'Flush scans', 'type': 'int', 'value': 0, 'limits': (0, 1e7)},
+                {'name': 'Command storage', 'type': 'list', 'values': fscv_daq.COMMAND_MODES,
+                        'value': 'full'},
+                {'name': 'Command threshold', 'type': 'float', 'value': 0.05, 'siPrefix': True,
+                        'suffix': 'V', 'limits': (0, 20)},
+                {'name': 'Command keep every', 'type': 'int', 'value': 0, 'limits': (0, 1e7)},
             ]},
             {'name': 'Valve control', 'type': 'group', 'children': [
                 {'name': 'Symphony', 'type': 'list', 'values': [NO_SYMPHONY_NAME]},
@@ -167,37 +233,41 @@ class FscvWin(QtWidgets.QMainWindow):
         p.param('Run', START_BACKGROUND_BTN_NAME).sigActivated.connect(self.start_background_recording)
 
         p.param('GUI', 'Load background').sigActivated.connect(self.load_background_open_file)
+        p.param('GUI', 'Mark background').sigActivated.connect(self.mark_background)
         p.param('Valve control', 'Reload symphonies').sigActivated.connect(self.load_symphonies)
 
+        # Only the storage settings that work together are offered
+        p.param('Data storage', 'Storage').sigValueChanged.connect(self.update_storage_options)
+        p.param('Data storage', 'Sample format').sigValueChanged.connect(self.update_storage_options)
+        p.param('Data storage', 'Compression library').sigValueChanged.connect(
+                self.update_storage_options)
+        self.update_storage_options()
+
         # Add parameter gui element
         parameter_gui_element = ParameterTree()
         parameter_gui_element.setParameters(p, showTop=False)
         parameter_gui_element.setWindowTitle('FSCV Settings')
         control_gui_element.addWidget(parameter_gui_element)
 
-
-        # Set up plotting with multithreading
-        # Current plot
-        self.remote_current_view = pg.widgets.RemoteGraphicsView.RemoteGraphicsView()
-        self.remote_current_view.pg.setConfigOptions(antialias=True) ## Create a PlotItem in the remote process
-        self.remote_current_plot = self.remote_current_view.pg.PlotItem()
-        self.remote_current_plot._setProxyOptions(deferGetattr=True)  ## speeds up access to plot
-        self.remote_current_view.setCentralItem(self.remote_current_plot)
-        current_view_gui_element.addWidget(self.remote_current_view)
-        # command plot
-        self.remote_command_view = pg.widgets.RemoteGraphicsView.RemoteGraphicsView()
-        self.remote_command_view.pg.setConfigOptions(antialias=True) ## Create a PlotItem in the remote process
-        self.remote_command_plot = self.remote_command_view.pg.PlotItem()
-        self.remote_command_plot._setProxyOptions(deferGetattr=True)  ## speeds up access to plot
-        self.remote_command_view.setCentralItem(self.remote_command_plot)
-        command_view_gui_element.addWidget(self.remote_command_view)
-        # duck plot
-        self.remote_duck_view = pg.widgets.RemoteGraphicsView.RemoteGraphicsView()
-        self.remote_duck_view.pg.setConfigOptions(antialias=True) ## Create a PlotItem in the remote process
-        self.remote_duck_plot = self.remote_duck_view.pg.PlotItem()
-        self.remote_duck_plot._setProxyOptions(deferGetattr=True)  ## speeds up access to plot
-        self.remote_duck_view.setCentralItem(self.remote_duck_plot)
-        duck_view_gui_element.addWidget(self.remote_duck_view)
+        # Monitor: live histogram of the recent trigger intervals
+        self.interval_plot = pg.PlotWidget(title='Trigger intervals')
+        self.interval_plot.setLabel('bottom', 'Interval', units='s')
+        self.interval_plot.setMaximumHeight(200)
+        control_gui_element.addWidget(self.interval_plot)
+
+
+        # Set up plotting in a separate render process. Current, command
+        # and duck plot share it, every update is a single message, see
+        # send_plots and fscv_render
+        self.remote_view = pg.widgets.RemoteGraphicsView.RemoteGraphicsView()
+        self.remote_view.pg.setConfigOptions(antialias=True)
+        render = self.remote_view._proc._import('fscv_render')
+        self.remote_plots = render.LivePlots(self.remote_view._view)
+        self.remote_plots._setProxyOptions(deferGetattr=True)  ## speeds up access to the plots
+        current_view_gui_element.addWidget(self.remote_view)
+        self.sent_command = None
+        self.latency_request = None
+        self.latency_time = 0
 
         # Waterfall plot
         self.im_plot = pg.ImageView()
@@ -235,52 +305,95 @@ class FscvWin(QtWidgets.QMainWindow):
             self.p.param('Valve control', 'Symphony').setLimits([NO_SYMPHONY_NAME])
             #self.p.param('Valve control', 'Symphony').value()
 
+    def update_storage_options(self):
+        """Limit the storage settings to the supported combinations: scan
+        encodings only with int16 samples, bitshuffle only with blosc, and
+        the npy storage only with the full command and no scan encoding"""
+        storage = self.p.param('Data storage')
+        npy = storage.param('Storage').value() == 'npy'
+        if storage.param('Sample format').value() == 'int16' and not npy:
+            storage.param('Scan encoding').setLimits(fscv_daq.SCAN_ENCODINGS)
+        else:
+            storage.param('Scan encoding').setLimits(['none'])
+        if npy:
+            storage.param('Command storage').setLimits(['full'])
+        else:
+            storage.param('Command storage').setLimits(fscv_daq.COMMAND_MODES)
+        if storage.param('Compression library').value().startswith('blosc'):
+            storage.param('Shuffle').setLimits(fscv_daq.SHUFFLE_MODES)
+        else:
+            storage.param('Shuffle').setLimits([m for m in fscv_daq.SHUFFLE_MODES
+                                                if m != 'bitshuffle'])
+
     def load_background_open_file(self):
         path_today = str(labtools.get_folder_of_the_day(self.config).absolute())
+        # npy recordings are opened with their metadata.json
         bg_filename, _ = QtGui.QFileDialog.getOpenFileName(self, caption='Select background recording',
-                                                               directory=path_today, filter='*.h5')
+                                                               directory=path_today,
+                                                               filter='*.h5 *.json')
         if bg_filename == '':
             return
 
         self.load_background(bg_filename=bg_filename)
 
     def load_background(self, bg_filename):
-        with tb.open_file(bg_filename, mode='r') as bg_file:
-            self.background_current = np.mean(bg_file.root.array_scans, 0)
+        with fscv_reader.open_recording(bg_filename) as bg_file:
+            electrode = min(self.p.param('GUI', 'Displayed electrode').value(),
+                            bg_file.n_electrodes - 1)
+            if bg_file.scan_mean is not None:
+                # Mean stored by the grabber, the scans are not read
+                self.background_current = bg_file.scan_mean[electrode].copy()
+                noise = np.sqrt(bg_file.scan_var[electrode].mean())
+            else:
+                scans = bg_file.electrodes[electrode][:]
+                self.background_current = np.mean(scans, 0)
+                noise = np.sqrt(np.var(scans, 0).mean())
+        self.p.param('GUI', 'Background noise').setValue(noise)
 
         short_filename = os.path.sep.join(bg_filename.split(os.path.sep)[-2:])
         self.p.param('GUI', 'Background file').setValue(short_filename)
+        self.p.param('GUI', 'Background mode').setValue('file')
         self.p.param('GUI', 'Live background subtraction').setValue(True)
-        self.p.param('GUI', 'Live background subtraction').setOpts(readonly=False)
+        # The engine is recreated with the new background
+        self.reset_background_engine()
+
+    def mark_background(self):
+        """Start or end the window of the 'marked' background"""
+        self.add_background_event('mark')
+
+    def add_background_event(self, kind):
+        """Chord change or mark at the latest acquired scan. The event waits
+        in background_events until the engine takes it, see
+        process_new_scans."""
+        if not self.p.param('Run', STOP_BTN_NAME).opts['enabled']:
+            print('Background %s ignored, not recording' % kind)
+            return
+        scan_index = self.grabber.snapshot(0).n_put
+        self.background_events.append((scan_index, kind))
+        print('Background %s at scan %i' % (kind, scan_index))
+
+    def reset_background_engine(self):
+        """The engine is recreated at the next update, the events it has not
+        handled yet are kept for the new one"""
+        if self.background_engine is not None:
+            self.background_events.extend(self.background_engine.events)
+        self.background_engine = None
 
     def play_symphony(self, symphony_name):
         """Parsing of .ini file, creation of chord list and timers"""
         self.symphony = self.symphonies[symphony_name]
         self.chordtimers = []
+        # Latest chord first, next_chord pops the earliest
         self.chords = []
 
-        try:
-            for k in sorted(self.symphony, reverse=True):
-                if k == FINAL_CHORD:
-                    # Final chord is not appended to the list.
-                    continue
-
-                chord = self.symphony[k].strip()
-                chordtime = float(k)*1e3
+        for chordtime, chord in reversed(fscv_valves.symphony_chords(self.symphony)):
+            self.chords.append(chord)
 
-                if chord.replace('0', '').replace('1', '').strip() != '':
-                    raise ValueError('Invalid character in chord: %s . Only 0 and 1 allowed.'%chord)
-                self.chords.append(chord)
-
-                timer = QtCore.QTimer()
-                timer.timeout.connect(self.next_chord)
-                timer.setSingleShot(True)
-                timer.start(int(chordtime))
-                self.chordtimers.append(timer)
-        except ValueError as e:
-            for timer in self.chordtimers:
-                timer.stop()
-            raise e
+            timer = QtCore.QTimer()
+            timer.timeout.connect(self.next_chord)
+            timer.setSingleShot(True)
+            timer.start(int(chordtime*1e3))
+            self.chordtimers.append(timer)
 
     def start_recording(self):
         """ This function starts a new recording. h5 storage, NiDAQ and the
@@ -292,38 +405,53 @@ class FscvWin(QtWidgets.QMainWindow):
         else:
             symphony_name = NO_SYMPHONY_NAME
 
-        # Load symphony
+        # Check the symphony, it is played once the grabber is created
         if symphony_name != NO_SYMPHONY_NAME:
-            # Store symphony
             try:
-                self.play_symphony(symphony_name)
+                fscv_valves.symphony_chords(self.symphonies[symphony_name])
             except ValueError as e:
                 pg.QtGui.QMessageBox.critical(self, 
                         "Parsing error in symphony: %s"%symphony_name+space,
                         "In section %s"%symphony_name+'\n'+str(e))
                 self.symphony = None
                 return
-        else:
-            self.symphony = None
 
 
         # Read gui values
         self.rate = self.p.param('Config', 'Sampling rate').value()
         self.samples_per_scan = self.p.param('Config', 'Samples per scan').value()
+        scans_per_callback = self.p.param('Config', 'Scans per callback').value()
+        separate_process = self.p.param('Config', 'Separate acquisition process').value()
+        n_electrodes = self.p.param('Config', 'Electrodes').value()
+        data_source = self.p.param('Config', 'Data source').value()
+        if data_source == 'replay':
+            backend = fscv_backends.ReplayBackend(self.p.param('Config', 'Replay file').value())
+        else:
+            backend = fscv_backends.BACKENDS[data_source]()
+        if self.p.param('Config', 'Max speed').value() and hasattr(backend, 'realtime'):
+            # The simulator and the replay run unpaced, e.g. for throughput tests
+            backend.realtime = False
         complevel = int(self.p.param('Data storage', 'Blosc compression level').value())
-
-        # Update Gui state
-        self.p.param('Run', START_BTN_NAME).setOpts(enabled=False)
-        self.p.param('Run', START_BACKGROUND_BTN_NAME).setOpts(enabled=False)
-        self.p.param('Run', STOP_BTN_NAME).setOpts(enabled=True)
-        self.p.param('Config', 'Sampling rate').setOpts(enabled=False)
-        self.p.param('Config', 'Samples per scan').setOpts(enabled=False)
-        self.p.param('Data storage', 'Blosc compression level').setOpts(enabled=False)
+        storage = self.p.param('Data storage', 'Storage').value()
+        complib = self.p.param('Data storage', 'Compression library').value()
+        shuffle = self.p.param('Data storage', 'Shuffle').value()
+        scan_encoding = self.p.param('Data storage', 'Scan encoding').value()
+        reference_every = self.p.param('Data storage', 'Reference every').value()
+        compression_threads = self.p.param('Data storage', 'Compression threads').value()
+        queue_depth = int(self.p.param('Data storage', 'Write queue depth').value())
+        batch_scans = int(self.p.param('Data storage', 'Write batch scans').value())
+        batch_period = self.p.param('Data storage', 'Write batch period').value()
+        scan_major = self.p.param('Data storage', 'Scan major layout').value()
+        sample_format = self.p.param('Data storage', 'Sample format').value()
+        segment_bytes = self.p.param('Data storage', 'Segment size').value()
+        segment_duration = self.p.param('Data storage', 'Segment duration').value()
+        flush_period = self.p.param('Data storage', 'Flush period').value()
+        flush_scans = self.p.param('Data storage', 'Flush scans').value()
+        command_mode = self.p.param('Data storage', 'Command storage').value()
+        command_threshold = self.p.param('Data storage', 'Command threshold').value()
+        command_keep_every = self.p.param('Data storage', 'Command keep every').value()
 
         datafile_path = labtools.getNextFile(self.config)
-        datafile_folder, datafile_name = os.path.split(datafile_path.absolute())
-        self.p.param('Data storage', 'Data path').setValue(datafile_folder)
-        self.p.param('Data storage', 'Data file').setValue(datafile_name)
 
         n_scans_limit = self.p.param('Run', 'N scans limit').value()
         if n_scans_limit == 0:
@@ -332,29 +460,107 @@ class FscvWin(QtWidgets.QMainWindow):
         else:
             expectedrows = n_scans_limit
 
-        self.grabber = fscv_daq.NIGrabber(complevel=complevel, expectedrows=expectedrows,
-                                            samples_per_scan=self.samples_per_scan, rate=self.rate,
-                                            filename=datafile_path.absolute())
-
-
+        grabber_kwargs = dict(complevel=complevel, complib=complib, shuffle=shuffle,
+                              scan_encoding=scan_encoding, reference_every=reference_every,
+                              compression_threads=compression_threads,
+                              storage=storage,
+                              expectedrows=expectedrows,
+                              samples_per_scan=self.samples_per_scan, rate=self.rate,
+                              filename=datafile_path.absolute(),
+                              queue_depth=queue_depth,
+                              batch_scans=batch_scans,
+                              batch_period=batch_period,
+                              scan_major=scan_major,
+                              sample_format=sample_format,
+                              scans_per_callback=scans_per_callback,
+                              n_electrodes=n_electrodes,
+                              backend=backend,
+                              segment_bytes=segment_bytes,
+                              segment_duration=segment_duration,
+                              flush_period=flush_period,
+                              flush_scans=flush_scans,
+                              command_mode=command_mode,
+                              command_threshold=command_threshold,
+                              command_keep_every=command_keep_every,
+                              live_depth=self.p.param('GUI', 'Waterfall n scans').value())
         # Store all GUI values in datafile
+        datafile_folder, datafile_name = os.path.split(datafile_path.absolute())
+        attrs = {}
         gui_params = self.p.getValues()
         for section in gui_params:
             prms = gui_params[section][1]
             for p in prms:
                 if p in [START_BACKGROUND_BTN_NAME , START_BTN_NAME, STOP_BTN_NAME]:
                     continue
-                self.grabber.array_ts.attrs[p.replace(' ', '_')] = prms[p][0]
+                attrs[p.replace(' ', '_')] = prms[p][0]
+        attrs['Data_path'] = datafile_folder
+        attrs['Data_file'] = datafile_name
 
         if symphony_name != NO_SYMPHONY_NAME:
-            for k in sorted(self.symphony, reverse=True):
-                if k == FINAL_CHORD:
-                    continue
-                chord = self.symphony[k].strip()
-                chordtime = int(float(k)*1e3)
-                self.grabber.array_ts.attrs['valve_pattern_at_%i_ms'%chordtime] = chord
+            for chordtime, chord in fscv_valves.symphony_chords(self.symphonies[symphony_name]):
+                attrs['valve_pattern_at_%i_ms'%int(chordtime*1e3)] = chord
+
+        # The grabber is created and started before the GUI state changes,
+        # so invalid settings (e.g. a scan encoding of float64 samples) or a
+        # failing DAQ leave the GUI ready for the next start
+        try:
+            if separate_process:
+                # Acquisition and storage run in their own process, the GUI
+                # gets the latest scans through shared memory
+                self.grabber = fscv_process.ProcessGrabber(**grabber_kwargs)
+            else:
+                self.grabber = fscv_daq.NIGrabber(**grabber_kwargs)
+            self.grabber.set_attrs(attrs)
+            self.grabber.start_grabbing()
+        except (ValueError, OSError, RuntimeError) as e:
+            self.grabber = None
+            if self.is_background:
+                self.p.param('Run', 'N scans limit').setValue(self.n_scans_pre)
+                self.p.param('Run', 'N scans limit').setOpts(enabled=True)
+                self.is_background = False
+            pg.QtGui.QMessageBox.critical(self, "Can not start the recording"+space, str(e))
+            return
+
+        if symphony_name != NO_SYMPHONY_NAME:
+            self.play_symphony(symphony_name)
+        else:
+            self.symphony = None
+
+        # Update Gui state
+        self.p.param('Run', START_BTN_NAME).setOpts(enabled=False)
+        self.p.param('Run', START_BACKGROUND_BTN_NAME).setOpts(enabled=False)
+        self.p.param('Run', STOP_BTN_NAME).setOpts(enabled=True)
+        self.p.param('Config', 'Sampling rate').setOpts(enabled=False)
+        self.p.param('Config', 'Samples per scan').setOpts(enabled=False)
+        self.p.param('Config', 'Scans per callback').setOpts(enabled=False)
+        self.p.param('Config', 'Separate acquisition process').setOpts(enabled=False)
+        self.p.param('Config', 'Electrodes').setOpts(enabled=False)
+        self.p.param('Config', 'Data source').setOpts(enabled=False)
+        self.p.param('Config', 'Replay file').setOpts(enabled=False)
+        self.p.param('Config', 'Max speed').setOpts(enabled=False)
+        self.p.param('GUI', 'Displayed electrode').setLimits((0, n_electrodes - 1))
+        self.p.param('Data storage', 'Blosc compression level').setOpts(enabled=False)
+        self.p.param('Data storage', 'Storage').setOpts(enabled=False)
+        self.p.param('Data storage', 'Compression library').setOpts(enabled=False)
+        self.p.param('Data storage', 'Shuffle').setOpts(enabled=False)
+        self.p.param('Data storage', 'Scan encoding').setOpts(enabled=False)
+        self.p.param('Data storage', 'Reference every').setOpts(enabled=False)
+        self.p.param('Data storage', 'Compression threads').setOpts(enabled=False)
+        self.p.param('Data storage', 'Write queue depth').setOpts(enabled=False)
+        self.p.param('Data storage', 'Write batch scans').setOpts(enabled=False)
+        self.p.param('Data storage', 'Write batch period').setOpts(enabled=False)
+        self.p.param('Data storage', 'Scan major layout').setOpts(enabled=False)
+        self.p.param('Data storage', 'Sample format').setOpts(enabled=False)
+        self.p.param('Data storage', 'Segment size').setOpts(enabled=False)
+        self.p.param('Data storage', 'Segment duration').setOpts(enabled=False)
+        self.p.param('Data storage', 'Flush period').setOpts(enabled=False)
+        self.p.param('Data storage', 'Flush scans').setOpts(enabled=False)
+        self.p.param('Data storage', 'Command storage').setOpts(enabled=False)
+        self.p.param('Data storage', 'Command threshold').setOpts(enabled=False)
+        self.p.param('Data storage', 'Command keep every').setOpts(enabled=False)
 
-        self.grabber.start_grabbing()
+        self.p.param('Data storage', 'Data path').setValue(datafile_folder)
+        self.p.param('Data storage', 'Data file').setValue(datafile_name)
 
         # Line and duck plot timer
         gui_period_ms = self.p.param('GUI', 'GUI update period').value()*1e3
@@ -362,7 +568,16 @@ class FscvWin(QtWidgets.QMainWindow):
         self.gui_timer.timeout.connect(self.update)
         self.gui_timer.start(int(gui_period_ms))
 
-        # Image timer
+        # Live scans are processed from the start of the acquisition, the
+        # waterfall image starts empty
+        self.n_put_processed = 0
+        self.n_scans_skipped = 0
+        self.current = None
+        self.background_engine = None
+        self.background_events = []
+        self.waterfall = None
+        self.rendered_waterfall = None
+        self.preview = []
         image_period_ms = self.p.param('GUI', 'Waterfall update period').value()*1e3
         self.image_timer = QtCore.QTimer()
         self.image_timer.timeout.connect(self.update_waterfall)
@@ -384,14 +599,7 @@ class FscvWin(QtWidgets.QMainWindow):
 
     def set_valves(self, chord):
         """Set the valves to a given chord, """
-        bool_chord = [x=="1" for x in chord.replace(' ', '')]
-
-        if VALVES_CONNECTED:
-            for i, ecu in enumerate(self.ecus):
-                if ecu is None:
-                    continue
-                self.ecus[i].set_enabled(1, bool_chord[i*2])
-                self.ecus[i].set_enabled(2, bool_chord[1+i*2])
+        self.valves.set(chord)
 
         self.p.param('Valve control', 'State').setValue("%s"%chord.replace(' ', '_'))
 
@@ -399,56 +607,156 @@ class FscvWin(QtWidgets.QMainWindow):
         """Update all the valves to the next chord in the symphony"""
         chord = self.chords.pop()
         self.set_valves(chord)
+        self.add_background_event('chord')
 
     def update_waterfall(self):
-        """Update the waterfall plot"""
-        if self.p.param('GUI', 'Live waterfall').value():
-            n_limit = self.p.param('GUI', 'Waterfall n scans').value()
-            currents = np.array(self.grabber.array_scans)[-n_limit:]
-
-            if self.p.param('GUI', 'Live background subtraction').value():
-                try:
-                    currents -= self.background_current
-                except ValueError:
-                    # Possibly number of samples per scan changed
-                    self.background_current = None
-                    self.p.param('GUI', 'Live background subtraction').setValue(False)
-                    self.p.param('GUI', 'Live background subtraction').setOpts(readonly=True)
-                    self.p.param('GUI', 'Background file').setValue('Cleared')
-                    return
-
-            self.im_plot.setImage(currents,
-                                  autoLevels=False,
-                                  autoHistogramRange=False,
-                                  autoRange=True)
+        """Show the new scans in the waterfall plot"""
+        if self.p.param('GUI', 'Live waterfall').value() and self.waterfall is not None:
+            if self.waterfall is not self.rendered_waterfall:
+                self.im_plot.setImage(self.waterfall.image,
+                                      autoLevels=False,
+                                      autoHistogramRange=False,
+                                      autoRange=True)
+            elif self.waterfall.n_added != self.n_rendered:
+                # Same shape, only the image item is updated
+                self.im_plot.getImageItem().setImage(self.waterfall.image,
+                                                     autoLevels=False)
+            self.rendered_waterfall = self.waterfall
+            self.n_rendered = self.waterfall.n_added
+
+    def process_new_scans(self):
+        """Background subtraction of the scans of the displayed electrode
+        acquired since the previous call. They are added to the waterfall
+        and the preview, the latest is kept as current."""
+        snapshot = self.grabber.snapshot()
+        if len(snapshot) == 0:
+            return
+        channel = self.displayed_channel(snapshot)
+        samples_per_scan = snapshot.data.shape[2]
+
+        # Engine and image start over when their settings change
+        engine_settings = (channel, self.p.param('GUI', 'Background mode').value(),
+                           self.p.param('GUI', 'Background scans').value())
+        if self.background_engine is None or self.engine_settings != engine_settings:
+            self.reset_background_engine()
+            self.background_engine = fscv_background.BackgroundEngine(
+                    samples_per_scan, engine_settings[1], engine_settings[2],
+                    background=self.background_current)
+            self.engine_settings = engine_settings
+        for scan_index, kind in self.background_events:
+            self.background_engine.add_event(kind, scan_index)
+        self.background_events = []
+        waterfall_settings = (channel, self.p.param('GUI', 'Waterfall n scans').value())
+        if self.waterfall is None or self.waterfall_settings != waterfall_settings:
+            self.waterfall = WaterfallImage(waterfall_settings[1], samples_per_scan)
+            self.waterfall_settings = waterfall_settings
+
+        n_new = min(snapshot.n_put - self.n_put_processed, len(snapshot))
+        if n_new <= 0:
+            return
+        start = len(snapshot) - n_new
+        scans = snapshot.scaled(channel, slice(start, None))
+        ts = snapshot.ts[start:].copy()
+        if not snapshot.valid():
+            # Overwritten while scaling, try again at the next update
+            return
+        first_index = snapshot.n_put - n_new
+        # Scans that left the live buffer before the GUI got to them are
+        # missing from the preview and the background windows
+        self.n_scans_skipped += first_index - self.n_put_processed
+        self.n_put_processed = snapshot.n_put
+
+        try:
+            subtracted = self.background_engine.add(scans, first_index)
+        except ValueError:
+            # Possibly number of samples per scan changed
+            self.background_current = None
+            self.reset_background_engine()
+            self.p.param('GUI', 'Background file').setValue('Cleared')
+            self.p.param('GUI', 'Live background subtraction').setValue(False)
+            return
+        if self.p.param('GUI', 'Live background subtraction').value():
+            scans = subtracted
+        self.waterfall.add(scans)
+        self.current = scans[-1]
+
+        preview_every = self.p.param('GUI', 'Preview every').value()
+        if preview_every > 0:
+            index = first_index + np.arange(n_new)
+            keep = index % preview_every == 0
+            if keep.any():
+                self.preview.append((ts[keep], index[keep], subtracted[keep]))
+
+    def write_preview(self, filename):
+        """Store the background subtracted preview next to the recording"""
+        if len(self.preview) == 0:
+            return
+        ts, index, scans = [np.concatenate(columns) for columns in zip(*self.preview)]
+        preview = fscv_background.write_preview(
+                filename, ts, index, scans,
+                mode=self.engine_settings[1], n_scans=self.engine_settings[2],
+                electrode=self.engine_settings[0] - 1,
+                every=self.p.param('GUI', 'Preview every').value(),
+                n_skipped=self.n_scans_skipped)
+        print('preview: ', preview)
+
+    def send_plots(self, current, command):
+        """Send the latest scan to the render process in one message. The
+        command is only sent when it deviates from the last sent one by more
+        than the command plot threshold. Message size and latency are shown
+        in the monitor."""
+        threshold = self.p.param('GUI', 'Command plot threshold').value()
+        if (self.sent_command is None or len(command) != len(self.sent_command)
+                or np.abs(command - self.sent_command).max() > threshold):
+            self.sent_command = command
+        else:
+            command = None
+        # float32 is plenty for display and halves the message
+        message = pickle.dumps((current.astype(np.float32),
+                                None if command is None else command.astype(np.float32)),
+                               protocol=pickle.HIGHEST_PROTOCOL)
+        # perf_counter is a system-wide clock, the render process compares
+        # it with its own
+        self.remote_plots.update(message, time.perf_counter(), _callSync='off')
+        self.p.param('Monitor', 'Plot message size').setValue(len(message))
+
+        # The latency statistics are fetched about once per second without
+        # waiting for the render process
+        if self.latency_request is not None and self.latency_request.hasResult():
+            latency, latency_max = self.latency_request.result()
+            self.latency_request = None
+            if np.isfinite(latency):
+                self.p.param('Monitor', 'Plot latency').setValue(latency)
+                self.p.param('Monitor', 'Plot latency max').setValue(latency_max)
+        now = time.perf_counter()
+        if self.latency_request is None and now - self.latency_time > 1:
+            self.latency_request = self.remote_plots.take_latency(_callSync='async')
+            self.latency_time = now
+
+    def displayed_channel(self, snapshot):
+        """Channel of the electrode selected for display, 0 is the command"""
+        electrode = self.p.param('GUI', 'Displayed electrode').value()
+        return 1 + min(electrode, snapshot.data.shape[1] - 2)
 
     def update(self):
         """This is the central function that is called in a loop. Data is
         acquired and shown in the GUI"""
 
-        # Plot last recording
-        current = self.grabber.array_scans[:, -1]
-        command = self.grabber.array_command[:, -1]
-
-        if len(current.shape) == 2:
+        # Plot last recording. The scans come from the grabber's live
+        # buffer, the file that is being written is never read here
+        snapshot = self.grabber.snapshot(1)
+        if len(snapshot) == 0:
             print('DAQ failed: empty data')
             return
+        command = snapshot.scaled(0, -1)
+        if not snapshot.valid():
+            return
+        self.process_new_scans()
+        if self.current is None:
+            return
+        current = self.current
 
-        if self.p.param('GUI', 'Live background subtraction').value():
-            try:
-                current -= self.background_current
-            except ValueError:
-                # Possibly number of samples per scan changed
-                self.background_current = None
-                self.p.param('GUI', 'Background file').setValue('Cleared')
-                self.p.param('GUI', 'Live background subtraction').setValue(False)
-                self.p.param('GUI', 'Live background subtraction').setOpts(readonly=True)
-                return
-
-        self.remote_current_plot.plot(current, clear=True, _callSync='off')
-        self.remote_command_plot.plot(command, clear=True, _callSync='off')
-        self.remote_duck_plot.plot(x=command, y=current,
-                                   clear=True, _callSync='off')
+        self.send_plots(current, command)
 
         # Calculate show sampling frequency
 
@@ -472,6 +780,18 @@ class FscvWin(QtWidgets.QMainWindow):
 
         n_scans_acquired = self.grabber.n_scans_acquired
         self.p.param('Monitor', 'N scans acquired').setValue(n_scans_acquired)
+        self.p.param('Monitor', 'Write queue').setValue(self.grabber.queue_length)
+        self.p.param('Monitor', 'Write queue max').setValue(self.grabber.queue_high_water)
+        self.p.param('Monitor', 'Write queue overflow').setValue(self.grabber.n_scans_overflow)
+        self.p.param('Monitor', 'Dropped scans').setValue(self.grabber.n_scans_dropped)
+        self.p.param('Monitor', 'Flushes').setValue(self.grabber.n_flushes)
+        self.p.param('Monitor', 'Flush duration max').setValue(self.grabber.flush_duration_max)
+        self.p.param('Monitor', 'Preview skipped scans').setValue(self.n_scans_skipped)
+
+        histogram = self.grabber.interval_histogram
+        if histogram is not None:
+            counts, edges = histogram
+            self.interval_plot.plot(edges, counts, stepMode='center', clear=True)
 
         # Check if measurement is finished
         n_scans_limit = self.p.param('Run', 'N scans limit').value()
@@ -486,8 +806,10 @@ class FscvWin(QtWidgets.QMainWindow):
         if AGILENT_CONNECTED:
             self.function_generator.output = False
 
-        # Stop recording and close file
+        # Stop recording and close file, the preview gets the last scans
+        self.process_new_scans()
         last_filename = self.grabber.stop_grab()
+        self.write_preview(last_filename)
 
         # If background recording, use result for background subtraction in plots
         if self.is_background:
@@ -502,8 +824,34 @@ class FscvWin(QtWidgets.QMainWindow):
         self.p.param('Run', STOP_BTN_NAME).setOpts(enabled=False)
         self.p.param('Config', 'Sampling rate').setOpts(enabled=True)
         self.p.param('Config', 'Samples per scan').setOpts(enabled=True)
+        self.p.param('Config', 'Scans per callback').setOpts(enabled=True)
+        self.p.param('Config', 'Separate acquisition process').setOpts(
+                enabled=fscv_process.SHARED_MEMORY_AVAILABLE)
+        self.p.param('Config', 'Electrodes').setOpts(enabled=True)
+        self.p.param('Config', 'Data source').setOpts(enabled=True)
+        self.p.param('Config', 'Replay file').setOpts(enabled=True)
+        self.p.param('Config', 'Max speed').setOpts(enabled=True)
+        self.p.param('GUI', 'Displayed electrode').setLimits((0, 7))
         self.p.param('Data storage',
                      'Blosc compression level').setOpts(enabled=True)
+        self.p.param('Data storage', 'Storage').setOpts(enabled=True)
+        self.p.param('Data storage', 'Compression library').setOpts(enabled=True)
+        self.p.param('Data storage', 'Shuffle').setOpts(enabled=True)
+        self.p.param('Data storage', 'Scan encoding').setOpts(enabled=True)
+        self.p.param('Data storage', 'Reference every').setOpts(enabled=True)
+        self.p.param('Data storage', 'Compression threads').setOpts(enabled=True)
+        self.p.param('Data storage', 'Write queue depth').setOpts(enabled=True)
+        self.p.param('Data storage', 'Write batch scans').setOpts(enabled=True)
+        self.p.param('Data storage', 'Write batch period').setOpts(enabled=True)
+        self.p.param('Data storage', 'Scan major layout').setOpts(enabled=True)
+        self.p.param('Data storage', 'Sample format').setOpts(enabled=True)
+        self.p.param('Data storage', 'Segment size').setOpts(enabled=True)
+        self.p.param('Data storage', 'Segment duration').setOpts(enabled=True)
+        self.p.param('Data storage', 'Flush period').setOpts(enabled=True)
+        self.p.param('Data storage', 'Flush scans').setOpts(enabled=True)
+        self.p.param('Data storage', 'Command storage').setOpts(enabled=True)
+        self.p.param('Data storage', 'Command threshold').setOpts(enabled=True)
+        self.p.param('Data storage', 'Command keep every').setOpts(enabled=True)
 
         # Stop timers
         self.gui_timer.stop()
@@ -523,9 +871,7 @@ class FscvWin(QtWidgets.QMainWindow):
         if self.p.param('Run', STOP_BTN_NAME).opts['enabled']:
             self.stop_recording()
 
-        self.remote_current_view.close()
-        self.remote_command_view.close()
-        self.remote_duck_view.close()
+        self.remote_view.close()
         event.accept()
 
 
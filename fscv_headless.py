@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""Headless FSCV recording, e.g. for overnight measurements.
+
+Drives a fscv_daq.NIGrabber without the GUI (no Qt is imported). The
+settings come from the command line and/or the [recording] section of a
+config file, the command line wins. Throughput and latency are logged
+periodically. The recording stops after the scan limit or duration, or on
+SIGINT (Ctrl-C) / SIGTERM, in all cases with the final write and flush.
+
+Usage:
+    python fscv_headless.py --rate 100e3 --samples-per-scan 1000 --n-scans 360000
+    python fscv_headless.py --config overnight.ini
+
+Example config file:
+    [recording]
+    rate = 100e3
+    samples_per_scan = 1000
+    duration = 43200
+    symphony = Test 1
+    complevel = 5
+"""
+import sys
+import time
+import signal
+import argparse
+import threading
+import configparser
+
+import labtools
+import fscv_daq
+import fscv_backends
+import fscv_valves
+
+CONFIG_SECTION = 'recording'
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Headless FSCV recording')
+    parser.add_argument('--config', help='config file with a [%s] section' % CONFIG_SECTION)
+    parser.add_argument('--filename', help='data file, default: next file of the day')
+    parser.add_argument('--rate', type=float, default=100e3, help='sampling rate [Hz]')
+    parser.add_argument('--samples-per-scan', type=int, default=1000)
+    parser.add_argument('--scans-per-callback', type=int, default=1)
+    parser.add_argument('--electrodes', type=int, default=1)
+    parser.add_argument('--n-scans', type=int, default=0, help='scan limit, 0: no limit')
+    parser.add_argument('--duration', type=float, default=0,
+                        help='recording duration [s], 0: no limit')
+    parser.add_argument('--symphony', default=None,
+                        help='valve symphony from symphonies.ini')
+    parser.add_argument('--symphonies-file', default='symphonies.ini')
+    parser.add_argument('--storage', default='hdf5', choices=fscv_daq.STORAGE_NAMES,
+                        help='hdf5 file or directory of memory-mapped .npy segments')
+    parser.add_argument('--complevel', type=int, default=5, help='compression level')
+    parser.add_argument('--complib', default='blosc', choices=fscv_daq.COMPLIBS,
+                        help='compression library, see benchmarks/bench_compression.py')
+    parser.add_argument('--shuffle', default='shuffle', choices=fscv_daq.SHUFFLE_MODES)
+    parser.add_argument('--scan-encoding', default='none', choices=fscv_daq.SCAN_ENCODINGS,
+                        help='delta encoding of int16 scans')
+    parser.add_argument('--reference-every', type=int, default=100,
+                        help='scans per block of the delta encoding')
+    parser.add_argument('--compression-threads', type=int, default=0,
+                        help='blosc compression threads, 0: PyTables default')
+    parser.add_argument('--sample-format', default='float64',
+                        choices=list(fscv_daq.SAMPLE_ATOMS))
+    parser.add_argument('--sample-major', action='store_true',
+                        help='old sample-major layout instead of scan-major')
+    parser.add_argument('--segment-size', type=float, default=0,
+                        help='roll over to a new segment file after this many MB, 0: never')
+    parser.add_argument('--segment-duration', type=float, default=0,
+                        help='roll over to a new segment file after this many s, 0: never')
+    parser.add_argument('--flush-period', type=float, default=5,
+                        help='flush the data file every this many s, 0: only at the end')
+    parser.add_argument('--flush-scans', type=int, default=0,
+                        help='flush the data file every this many scans, 0: never')
+    parser.add_argument('--command-mode', default='full', choices=fscv_daq.COMMAND_MODES,
+                        help='store the command of every scan or a template')
+    parser.add_argument('--command-threshold', type=float, default=0.05,
+                        help='template mode: store scans deviating more than this [V]')
+    parser.add_argument('--command-keep-every', type=int, default=0,
+                        help='template mode: store every this many scans, 0: never')
+    parser.add_argument('--queue-depth', type=int, default=1000)
+    parser.add_argument('--batch-scans', type=int, default=10)
+    parser.add_argument('--batch-period', type=float, default=0.5)
+    parser.add_argument('--backend', default=None, choices=list(fscv_backends.BACKENDS),
+                        help='data source, default: nidaqmx if installed, else simulator')
+    parser.add_argument('--replay-file', help='recording replayed by the replay backend')
+    parser.add_argument('--max-speed', action='store_true',
+                        help='run the simulator or replay as fast as possible, not in real time')
+    parser.add_argument('--log-period', type=float, default=10, help='status log period [s]')
+    return parser
+
+
+def parse_args(argv=None):
+    """Command line arguments, with defaults from the config file"""
+    parser = make_parser()
+    args, _ = parser.parse_known_args(argv)
+    if args.config is not None:
+        config = configparser.ConfigParser()
+        if not config.read(args.config):
+            parser.error('Config file not found: %s' % args.config)
+        section = config[CONFIG_SECTION]
+        defaults = {}
+        for key in section:
+            dest = key.replace('-', '_')
+            if dest not in vars(args):
+                parser.error('Unknown setting in %s: %s' % (args.config, key))
+            if isinstance(parser.get_default(dest), bool):
+                defaults[dest] = section.getboolean(key)
+            else:
+                # String defaults are converted with the type of the argument
+                defaults[dest] = section[key]
+        parser.set_defaults(**defaults)
+    return parser.parse_args(argv)
+
+
+def make_backend(args):
+    if args.backend is None:
+        backend = fscv_backends.default_backend()
+    elif args.backend == 'replay':
+        if args.replay_file is None:
+            raise ValueError('The replay backend needs --replay-file')
+        backend = fscv_backends.ReplayBackend(args.replay_file)
+    else:
+        backend = fscv_backends.BACKENDS[args.backend]()
+    if args.max_speed:
+        # Only the simulator and the replay are paced
+        if not hasattr(backend, 'realtime'):
+            raise ValueError('--max-speed needs the simulator or the replay backend')
+        backend.realtime = False
+    return backend
+
+
+class SymphonyPlayer:
+    """Plays the chords of a symphony with timers, from the start of the
+    recording"""
+    def __init__(self, symphony, valves):
+        self.symphony = symphony
+        self.valves = valves
+        self.timers = [threading.Timer(chordtime, self.set_chord, args=(chord,))
+                       for chordtime, chord in fscv_valves.symphony_chords(symphony)]
+
+    def set_chord(self, chord):
+        self.valves.set(chord)
+        print('%s valves: %s' % (time.strftime('%H:%M:%S'), chord), flush=True)
+
+    def start(self):
+        for timer in self.timers:
+            timer.start()
+
+    def stop(self):
+        """Cancel the remaining chords and apply the final chord"""
+        for timer in self.timers:
+            timer.cancel()
+        if self.symphony.get(fscv_valves.FINAL_CHORD) is not None:
+            self.set_chord(self.symphony.get(fscv_valves.FINAL_CHORD))
+
+
+def log_status(grabber, t_start, n_scans_last, t_last):
+    """Print one status line: throughput since the last line and latencies"""
+    now = time.perf_counter()
+    n_scans = grabber.n_scans_acquired
+    throughput = (n_scans - n_scans_last) / (now - t_last)
+
+    def ms(value):
+        return '-' if value is None else '%.2f' % (value * 1e3)
+    print('%s t=%.0fs scans=%i (%.1f/s) written=%i queue=%i (max %i) '
+          'write latency=%sms scan period=%sms [%s..%s] dropped=%i flushes=%i (max %sms)'
+          % (time.strftime('%H:%M:%S'), now - t_start, n_scans, throughput,
+             grabber.n_scans_written, grabber.queue_length, grabber.queue_high_water,
+             ms(grabber.write_latency), ms(grabber.delta_t), ms(grabber.delta_t_min),
+             ms(grabber.delta_t_max), grabber.n_scans_dropped, grabber.n_flushes,
+             ms(grabber.flush_duration_max)), flush=True)
+    return n_scans, now
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = labtools.getConfig()
+
+    symphony = None
+    if args.symphony:
+        symphonies = configparser.ConfigParser()
+        symphonies.read(args.symphonies_file)
+        symphony = symphonies[args.symphony]
+
+    # Invalid chords are reported before the data file is created
+    player = None
+    if symphony is not None:
+        player = SymphonyPlayer(symphony, fscv_valves.ValveController(
+            labtools.getConfig('ECUS')))
+
+    filename = args.filename or labtools.getNextFile(config).absolute()
+    if args.n_scans:
+        expectedrows = args.n_scans
+    elif args.duration:
+        expectedrows = int(args.duration * args.rate / args.samples_per_scan)
+    else:
+        expectedrows = 500
+
+    grabber = fscv_daq.NIGrabber(complevel=args.complevel, complib=args.complib,
+                                 shuffle=args.shuffle, scan_encoding=args.scan_encoding,
+                                 reference_every=args.reference_every,
+                                 compression_threads=args.compression_threads,
+                                 storage=args.storage,
+                                 expectedrows=expectedrows,
+                                 samples_per_scan=args.samples_per_scan, rate=args.rate,
+                                 filename=filename,
+                                 queue_depth=args.queue_depth,
+                                 batch_scans=args.batch_scans,
+                                 batch_period=args.batch_period,
+                                 scan_major=not args.sample_major,
+                                 sample_format=args.sample_format,
+                                 scans_per_callback=args.scans_per_callback,
+                                 n_electrodes=args.electrodes,
+                                 backend=make_backend(args),
+                                 segment_bytes=args.segment_size * 1e6,
+                                 segment_duration=args.segment_duration,
+                                 flush_period=args.flush_period,
+                                 flush_scans=args.flush_scans,
+                                 command_mode=args.command_mode,
+                                 command_threshold=args.command_threshold,
+                                 command_keep_every=args.command_keep_every)
+
+    # Store the settings in the data file, like the GUI does
+    attrs = {k: v for k, v in vars(args).items() if v is not None}
+    attrs['headless'] = True
+    if symphony is not None:
+        for chordtime, chord in fscv_valves.symphony_chords(symphony):
+            attrs['valve_pattern_at_%i_ms' % int(chordtime * 1e3)] = chord
+    grabber.set_attrs(attrs)
+
+    # SIGINT and SIGTERM end the main loop, the recording is then stopped
+    # normally
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        print('%s received, stopping' % signal.Signals(signum).name, flush=True)
+        stop_event.set()
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    print('Recording to %s' % filename, flush=True)
+    grabber.start_grabbing()
+    if player is not None:
+        player.start()
+    t_start = t_last = t_log = time.perf_counter()
+    n_scans_last = 0
+
+    try:
+        # The limits are checked every 0.1 s
+        while not stop_event.is_set():
+            stop_event.wait(min(args.log_period, 0.1))
+            now = time.perf_counter()
+            if args.n_scans and grabber.n_scans_acquired >= args.n_scans:
+                break
+            if args.duration and now - t_start >= args.duration:
+                break
+            if getattr(grabber.backend, 'finished', False):
+                print('End of replayed recording', flush=True)
+                break
+            if now - t_log >= args.log_period:
+                n_scans_last, t_last = log_status(grabber, t_start, n_scans_last, t_last)
+                t_log = now
+    finally:
+        if player is not None:
+            player.stop()
+        log_status(grabber, t_start, n_scans_last, t_last)
+        grabber.stop_grab()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
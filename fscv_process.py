@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""Acquisition and storage in a separate process.
+
+ProcessGrabber has the interface of fscv_daq.NIGrabber, but the grabber,
+its writer thread and the compression run in their own process. New scans
+are published through a shared memory ring (SharedScanRing), which the GUI
+process maps read-only. Start, stop and status requests go over a pipe.
+Hiccups of the GUI (redraws, parameter tree updates) can therefore not
+delay the acquisition.
+
+Requires python >= 3.8 (multiprocessing.shared_memory).
+"""
+import time
+import multiprocessing
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+    SHARED_MEMORY_AVAILABLE = True
+except ImportError:
+    SHARED_MEMORY_AVAILABLE = False
+
+import fscv_daq
+
+# Grabber attributes that are reported by a status request
+STATUS_ATTRIBUTES = ['n_scans_acquired', 'delta_t', 'delta_t_min', 'delta_t_max',
+                     'queue_length', 'queue_high_water', 'n_scans_overflow',
+                     'n_scans_dropped', 'interval_histogram', 'n_scans_written',
+                     'write_latency', 'n_flushes', 'flush_duration_max']
+
+
+class SharedScanRing(fscv_daq.LiveScanBuffer):
+    """fscv_daq.LiveScanBuffer in shared memory.
+
+    The acquisition process writes, the GUI process maps the same memory
+    read-only (name given) and takes snapshots of it."""
+    def __init__(self, depth, n_channels, samples_per_scan, dtype=np.float64,
+                 headroom=None, name=None):
+        self.name = name
+        super().__init__(depth, n_channels, samples_per_scan, dtype, headroom)
+
+    def allocate(self):
+        header_bytes = 16
+        ts_bytes = 8 * 2 * self.n_slots
+        data_bytes = (self.dtype.itemsize * 2 * self.n_slots * self.n_channels
+                      * self.samples_per_scan)
+        if self.name is None:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=header_bytes + ts_bytes + data_bytes)
+        else:
+            self.shm = shared_memory.SharedMemory(name=self.name)
+
+        buf = self.shm.buf
+        self.header = np.ndarray((2,), dtype=np.int64, buffer=buf)
+        self.ts = np.ndarray((2 * self.n_slots,), dtype=np.float64, buffer=buf,
+                             offset=header_bytes)
+        self.data = np.ndarray((2 * self.n_slots, self.n_channels, self.samples_per_scan),
+                               dtype=self.dtype, buffer=buf, offset=header_bytes + ts_bytes)
+        if self.name is None:
+            self.header[:] = 0
+            self.name = self.shm.name
+
+    def set_readonly(self):
+        for a in (self.header, self.ts, self.data):
+            a.flags.writeable = False
+
+    def kwargs(self):
+        """Arguments to map this ring in another process"""
+        return dict(depth=self.depth, n_channels=self.n_channels,
+                    samples_per_scan=self.samples_per_scan, dtype=self.dtype.str,
+                    headroom=self.headroom, name=self.name)
+
+    def close(self):
+        # The numpy views have to be released before unmapping the memory
+        self.header = self.ts = self.data = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def send_error(conn, e):
+    """Send an exception to the GUI process, which raises it again"""
+    try:
+        conn.send(e)
+    except Exception:
+        # Not picklable
+        conn.send(RuntimeError('%s: %s' % (type(e).__name__, e)))
+
+
+def run_grabber(conn, grabber_kwargs, ring_kwargs):
+    """Main function of the acquisition process: owns the NIGrabber and
+    serves requests from the control pipe until it is stopped"""
+    ring = SharedScanRing(**ring_kwargs)
+    try:
+        grabber = fscv_daq.NIGrabber(live_buffer=ring, **grabber_kwargs)
+    except Exception as e:
+        # e.g. invalid settings or an unwritable file
+        send_error(conn, e)
+        ring.close()
+        return
+    conn.send(None)
+
+    while True:
+        command, arg = conn.recv()
+        if command == 'attrs':
+            grabber.set_attrs(arg)
+            conn.send(None)
+        elif command == 'start':
+            try:
+                grabber.start_grabbing()
+            except Exception as e:
+                # e.g. the DAQ is missing, the grabber removed the file
+                send_error(conn, e)
+                break
+            conn.send(grabber.scale_coeffs)
+        elif command == 'status':
+            conn.send({a: getattr(grabber, a) for a in STATUS_ATTRIBUTES})
+        elif command == 'stop':
+            filename = grabber.stop_grab()
+            conn.send((filename, {a: getattr(grabber, a) for a in STATUS_ATTRIBUTES}))
+            break
+
+    ring.close()
+
+
+class ProcessGrabber:
+    """Runs a fscv_daq.NIGrabber in a separate process.
+
+    Takes the NIGrabber arguments, live_depth is the number of latest scans
+    available for the GUI. Status values are requested from the acquisition
+    process at most every status_period seconds."""
+    def __init__(self, live_depth=1000, status_period=0.05, **grabber_kwargs):
+        if not SHARED_MEMORY_AVAILABLE:
+            raise RuntimeError('A separate acquisition process requires python >= 3.8')
+
+        samples_per_scan = grabber_kwargs.get('samples_per_scan', 1000)
+        sample_format = grabber_kwargs.get('sample_format', 'float64')
+        n_electrodes = grabber_kwargs.get('n_electrodes', 1)
+        self.ring = SharedScanRing(live_depth, 1 + n_electrodes, samples_per_scan,
+                                   dtype=fscv_daq.SAMPLE_ATOMS[sample_format].dtype)
+
+        self.status_period = status_period
+        self.status = {a: None for a in STATUS_ATTRIBUTES}
+        self.status_time = 0
+
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=run_grabber,
+                                               args=(child_conn, grabber_kwargs,
+                                                     self.ring.kwargs()),
+                                               daemon=True)
+        self.process.start()
+        # Only the child uses its end, so recv gets EOF if the child dies
+        child_conn.close()
+        # Wait until the file is opened
+        try:
+            error = self.conn.recv()
+        except EOFError:
+            error = RuntimeError('The acquisition process terminated')
+        if error is not None:
+            self.close()
+            raise error
+
+        # The GUI process only reads from the ring
+        self.ring.set_readonly()
+
+    def request(self, command, arg=None):
+        try:
+            self.conn.send((command, arg))
+            return self.conn.recv()
+        except (EOFError, BrokenPipeError):
+            raise RuntimeError('The acquisition process terminated')
+
+    def close(self):
+        """Wait for the acquisition process and release the ring"""
+        self.process.join()
+        self.conn.close()
+        self.ring.close()
+        self.ring.unlink()
+
+    def set_attrs(self, attrs):
+        self.request('attrs', attrs)
+
+    def start_grabbing(self):
+        result = self.request('start')
+        if isinstance(result, Exception):
+            # The acquisition process ended
+            self.close()
+            raise result
+        self.ring.scale_coeffs = result
+
+    def snapshot(self, n=None):
+        """The latest (at most n) scans of all channels, see
+        fscv_daq.NIGrabber.snapshot"""
+        return self.ring.snapshot(n)
+
+    def stop_grab(self):
+        filename, self.status = self.request('stop')
+        self.close()
+        return filename
+
+    def update_status(self):
+        now = time.perf_counter()
+        if not self.process.is_alive():
+            # Stopped, the final status was sent by stop
+            return self.status
+        if now - self.status_time > self.status_period:
+            self.status = self.request('status')
+            self.status_time = now
+        return self.status
+
+    def __getattr__(self, name):
+        # Status values like n_scans_acquired are read from the process
+        if name in STATUS_ATTRIBUTES:
+            return self.update_status()[name]
+        raise AttributeError(name)
@@ -0,0 +1,691 @@
+# -*- coding: utf-8 -*-
+"""Reading of FSCV data files.
+
+Older files store scans sample-major, i.e. array_scans has the shape
+(samples_per_scan, n_scans) and array_ts (1, n_scans). Newer files can be
+scan-major: (n_scans, samples_per_scan) and (n_scans,). The classes in this
+module hide the difference, all data is returned scan-major.
+
+Multi-electrode files have one scan array per working electrode:
+array_scans (electrode 0), array_scans_1, array_scans_2, ...
+
+Samples can be stored as float64, float32 or as unscaled int16 ADC codes.
+For int16 arrays the polynomial scaling coefficients are stored in the
+'scale_coeffs' attribute and the data is returned in volts.
+
+Files written by fscv_daq hold the mean and variance over all scans of
+every sample (array_stats_mean and array_stats_var, (n_electrodes,
+samples_per_scan), in volts) as scan_mean and scan_var, e.g. to use a
+recording as background without reading its scans.
+
+The command voltage can be stored as a template (command_mode 'template'):
+array_command_template holds the first scan of the file, array_command_stats
+the deviation of every scan from it and array_command only the scans listed
+in array_command_index. The command of the other scans is returned as the
+template, so data.command looks the same for both modes.
+
+int16 scans can be delta encoded (attribute scan_encoding 'reference' or
+'previous', see fscv_daq.DeltaEncoder) for better compression, they are
+decoded when read.
+
+Long recordings can be split into segments (fscv0001_000.h5,
+fscv0001_001.h5, ...). The manifest fscv0001.json lists the segments in
+order, SegmentedFscvFile presents them as one continuous recording.
+
+Instead of HDF5, a recording can be stored as a directory fscv0001.npyrec
+of uncompressed, scan-major .npy segments of a fixed number of scans per
+array (scans_000.npy, scans_001.npy, command_000.npy, ts_000.npy, ...)
+and metadata.json. NpyRecording memory-maps the segments, so reading
+scans costs no decompression and slices within a segment are views.
+open_recording opens all kinds.
+
+Example:
+    with fscv_reader.open_recording('fscv0001.h5') as data:
+        last_scan = data.scans[-1]
+        waterfall = data.scans[:]
+        t = data.ts[:]
+"""
+import os
+import copy
+import json
+import threading
+import numpy as np
+import tables as tb
+
+MANIFEST_FORMAT = 'fscv-segments'
+NPY_FORMAT = 'fscv-npy'
+NPY_SUFFIX = '.npyrec'
+NPY_METADATA = 'metadata.json'
+
+# PyTables is not thread safe. Threads that use it while another thread
+# writes a recording (fscv_backends.ReplayBackend and the writer thread of
+# fscv_daq.NIGrabber) hold this lock.
+TABLES_LOCK = threading.RLock()
+
+
+def scans_array_name(electrode):
+    """Name of the scan array of an electrode"""
+    if electrode == 0:
+        return 'array_scans'
+    return 'array_scans_%i' % electrode
+
+
+def manifest_filename(filename):
+    """Manifest of a segmented recording, e.g. fscv0001.h5 -> fscv0001.json"""
+    return os.path.splitext(str(filename))[0] + '.json'
+
+
+def segment_filename(filename, segment):
+    """Filename of a segment, e.g. fscv0001.h5, 2 -> fscv0001_002.h5"""
+    root, ext = os.path.splitext(str(filename))
+    return '%s_%03i%s' % (root, segment, ext)
+
+
+def read_manifest(filename):
+    with open(filename) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != MANIFEST_FORMAT:
+        raise ValueError('Not a segment manifest: %s' % filename)
+    return manifest
+
+
+def write_json(filename, data):
+    """Write a JSON file atomically, readers never see a partial file.
+    numpy values are converted to python values."""
+    def convert(value):
+        if isinstance(value, (np.ndarray, np.generic)):
+            return value.tolist()
+        return str(value)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(data, f, indent=1, default=convert)
+    os.replace(tmp_filename, filename)
+
+
+def write_manifest(filename, manifest):
+    write_json(filename, dict(manifest, format=MANIFEST_FORMAT))
+
+
+def npy_dirname(filename):
+    """Directory of a npy recording, e.g. fscv0001.h5 -> fscv0001.npyrec"""
+    return os.path.splitext(str(filename))[0] + NPY_SUFFIX
+
+
+def npy_segment_filename(dirname, name, segment):
+    """Segment file of an array of a npy recording, e.g. scans, 2 ->
+    scans_002.npy. Arrays are named like the HDF5 arrays without 'array_'"""
+    return os.path.join(str(dirname), '%s_%03i.npy' % (name, segment))
+
+
+def npy_channel_names(n_electrodes):
+    """Array names of the channels of a npy recording: command, electrodes"""
+    return ['command'] + [scans_array_name(i)[len('array_'):] for i in range(n_electrodes)]
+
+
+def merge_statistics(n_a, mean_a, m2_a, n_b, mean_b, m2_b):
+    """Merge the count, mean and sum of squared deviations of two sets of
+    scans (Chan et al.), returns (n, mean, m2) of the union"""
+    n = n_a + n_b
+    if n == 0:
+        return 0, mean_a, m2_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    m2 = m2_a + m2_b + delta**2 * (n_a * n_b / n)
+    return n, mean, m2
+
+
+def read_npy_metadata(dirname):
+    with open(os.path.join(str(dirname), NPY_METADATA)) as f:
+        metadata = json.load(f)
+    if metadata.get('format') != NPY_FORMAT:
+        raise ValueError('Not a npy recording: %s' % dirname)
+    return metadata
+
+
+class LazyArray:
+    """Base class of the lazy views, reading only the indexed part. The
+    subclasses define shape and __getitem__."""
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[:]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+
+class LazyScanArray(LazyArray):
+    """Base class of the lazy scan-major views (n_scans, samples_per_scan).
+    Raw integer samples are scaled to volts with the 'scale_coeffs'
+    attribute unless scaled is False. The subclasses define attrs and
+    stored_dtype and apply scale_coeffs when reading."""
+    def __init__(self, scaled=True):
+        self.scale_coeffs = None
+        if scaled and 'scale_coeffs' in self.attrs:
+            self.scale_coeffs = np.asarray(self.attrs['scale_coeffs'], dtype=np.float64)
+
+    @property
+    def raw(self):
+        """View of the stored, unscaled samples"""
+        raw = copy.copy(self)
+        raw.scale_coeffs = None
+        return raw
+
+    @property
+    def dtype(self):
+        if self.scale_coeffs is not None:
+            return np.dtype(np.float64)
+        return self.stored_dtype
+
+
+class ScanArray(LazyScanArray):
+    """Lazy scan-major view (n_scans, samples_per_scan) of a scan EArray.
+
+    Indexing reads only the requested part from the file, e.g.
+    scans[-1] is the last scan and scans[10:20, :100] the first 100 samples
+    of ten scans. Raw integer samples are scaled to volts unless scaled is
+    False."""
+    def __init__(self, node, scaled=True):
+        self.node = node
+        # EArrays grow along their extendable dimension
+        self.scan_major = node.extdim == 0
+        super().__init__(scaled)
+
+    @property
+    def shape(self):
+        shape = tuple(int(n) for n in self.node.shape)
+        if self.scan_major:
+            return shape
+        return shape[::-1]
+
+    @property
+    def stored_dtype(self):
+        return self.node.dtype
+
+    @property
+    def attrs(self):
+        return self.node.attrs
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if self.scan_major:
+            data = self.node[key]
+        else:
+            key = key + (slice(None),) * (2 - len(key))
+            # Transposing a 1d result is a no-op, 2d results are made scan-major
+            data = self.node[key[1], key[0]].T
+
+        if self.scale_coeffs is not None:
+            data = np.polynomial.polynomial.polyval(data, self.scale_coeffs)
+        return data
+
+
+def scan_indices(key, n):
+    """Scan indices selected by the first axis of key (integer or slice) of
+    an array with n scans, and the rest of key"""
+    if not isinstance(key, tuple):
+        key = (key,)
+    first, rest = key[0], key[1:]
+    if isinstance(first, (int, np.integer)):
+        if not -n <= first < n:
+            raise IndexError('Index %i out of range' % first)
+        return np.array([first % n]), rest
+    if isinstance(first, slice):
+        return np.arange(*first.indices(n)), rest
+    raise IndexError('Only integers and slices are supported')
+
+
+def select_scans(data, key, rest, scale_coeffs):
+    """Apply the rest of key to the scans (n, samples) read for the first
+    axis of key and scale them"""
+    first = key[0] if isinstance(key, tuple) else key
+    if isinstance(first, (int, np.integer)):
+        data = data[0]
+    if rest:
+        data = data[(slice(None),) + rest] if data.ndim == 2 else data[rest]
+    if scale_coeffs is not None:
+        data = np.polynomial.polynomial.polyval(data, scale_coeffs)
+    return data
+
+
+def unzigzag(codes):
+    """int16 differences of zigzag mapped codes, see fscv_daq.DeltaEncoder"""
+    codes = codes.view(np.uint16)
+    return (codes >> 1).view(np.int16) ^ -(codes & 1).view(np.int16)
+
+
+class DeltaScanArray(LazyScanArray):
+    """Lazy scan-major view of delta encoded int16 scans (scan_encoding
+    'reference' or 'previous', see fscv_daq.DeltaEncoder), with the
+    interface of ScanArray for integers and slices on the first axis.
+    Decoding is vectorized and reads at most one block of reference_every
+    scans before the requested ones."""
+    def __init__(self, node, scaled=True):
+        self.node = node
+        self.stored = ScanArray(node, scaled=False)
+        self.scan_major = self.stored.scan_major
+        self.encoding = node.attrs['scan_encoding']
+        self.reference_every = int(node.attrs['reference_every'])
+        self.references = None
+        if self.encoding == 'reference':
+            self.references = node._v_file.get_node(node._v_parent, node.name + '_reference')
+        super().__init__(scaled)
+
+    @property
+    def shape(self):
+        return self.stored.shape
+
+    @property
+    def stored_dtype(self):
+        return self.node.dtype
+
+    @property
+    def attrs(self):
+        return self.node.attrs
+
+    def __getitem__(self, key):
+        indices, rest = scan_indices(key, len(self))
+        if len(indices) == 0:
+            data = self.stored[0:0]
+        else:
+            first, last = indices.min(), indices.max()
+            block = indices // self.reference_every
+            if self.encoding == 'reference':
+                deltas = unzigzag(self.stored[first:last+1])
+                first_block = first // self.reference_every
+                references = self.references[first_block:last // self.reference_every + 1]
+                data = deltas[indices - first] + references[block - first_block]
+            else:
+                # Sum the differences from the start of the first block
+                start = first // self.reference_every * self.reference_every
+                sums = np.cumsum(unzigzag(self.stored[start:last+1]), axis=0,
+                                 dtype=self.node.dtype)
+                data = sums[indices - start]
+                before_block = block * self.reference_every - start - 1
+                continued = before_block >= 0
+                data[continued] -= sums[before_block[continued]]
+        return select_scans(data, key, rest, self.scale_coeffs)
+
+
+def scan_array(node):
+    """Scan-major view of a scan EArray, decoding delta encoded scans"""
+    if 'scan_encoding' in node.attrs and node.attrs['scan_encoding'] != 'none':
+        return DeltaScanArray(node)
+    return ScanArray(node)
+
+
+class TemplateCommandArray(LazyScanArray):
+    """Lazy scan-major view of a command stored as template (see the module
+    docstring), with the interface of ScanArray for integers and slices on
+    the first axis. Scans that were kept in full are returned as stored,
+    all others as the template."""
+    def __init__(self, root, scaled=True):
+        self.root = root
+        self.stored = ScanArray(root.array_command, scaled=False)
+        self.scan_major = self.stored.scan_major
+        self.template = root.array_command_template
+        self.index = root.array_command_index
+        self.stats = root.array_command_stats
+        super().__init__(scaled)
+
+    @property
+    def shape(self):
+        return (int(self.stats.nrows), int(self.template.shape[1]))
+
+    @property
+    def stored_dtype(self):
+        return self.template.dtype
+
+    @property
+    def attrs(self):
+        return self.root.array_command.attrs
+
+    def __getitem__(self, key):
+        indices, rest = scan_indices(key, len(self))
+        data = np.empty((len(indices), self.shape[1]), dtype=self.template.dtype)
+        if len(indices):
+            data[:] = self.template[0]
+            # Scans kept in full. While a file is written, the index can be
+            # ahead of array_command
+            kept = self.index[:min(self.index.nrows, len(self.stored))]
+            pos = np.searchsorted(kept, indices)
+            found = pos < len(kept)
+            found[found] = kept[pos[found]] == indices[found]
+            if found.any():
+                first_kept, last_kept = pos[found].min(), pos[found].max()
+                rows = self.stored[first_kept:last_kept+1]
+                data[found] = rows[pos[found] - first_kept]
+
+        return select_scans(data, key, rest, self.scale_coeffs)
+
+
+def command_array(root):
+    """Scan-major view of the command of a file, for both command modes"""
+    if 'array_command_stats' in root:
+        return TemplateCommandArray(root)
+    return scan_array(root.array_command)
+
+
+class TimeArray(LazyArray):
+    """Lazy 1d view of the timestamp EArray, independent of the layout"""
+    def __init__(self, node):
+        self.node = node
+        self.scan_major = len(node.shape) == 1
+
+    @property
+    def shape(self):
+        return (int(self.node.nrows),)
+
+    @property
+    def attrs(self):
+        return self.node.attrs
+
+    def __getitem__(self, key):
+        if self.scan_major:
+            return self.node[key]
+        return self.node[0, key]
+
+
+class ConcatArray(LazyArray):
+    """Lazy concatenation of arrays along the first axis, e.g. the ScanArrays
+    of the segments of a recording.
+
+    Supports the indexing of the parts for integers and slices on the first
+    axis, reading only from the parts that are needed. The parts may grow."""
+    def __init__(self, parts):
+        self.parts = parts
+
+    @property
+    def shape(self):
+        return (len(self),) + tuple(self.parts[0].shape[1:])
+
+    @property
+    def dtype(self):
+        return self.parts[0].dtype
+
+    @property
+    def attrs(self):
+        return self.parts[0].attrs
+
+    @property
+    def scale_coeffs(self):
+        return getattr(self.parts[0], 'scale_coeffs', None)
+
+    @property
+    def raw(self):
+        return ConcatArray([part.raw for part in self.parts])
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    @staticmethod
+    def get(part, first, rest):
+        if rest:
+            return part[(first,) + rest]
+        return part[first]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        first, rest = key[0], key[1:]
+        n = len(self)
+
+        if isinstance(first, (int, np.integer)):
+            i = first + n if first < 0 else first
+            if not 0 <= i < n:
+                raise IndexError('Index %i out of range' % first)
+            for part in self.parts:
+                if i < len(part):
+                    return self.get(part, i, rest)
+                i -= len(part)
+        if not isinstance(first, slice):
+            raise IndexError('Only integers and slices are supported')
+
+        indices = range(*first.indices(n))
+        if indices.step < 0:
+            if len(indices) == 0:
+                return self[(slice(0, 0),) + rest]
+            forward = slice(indices[-1], indices[0] + 1, -indices.step)
+            return self[(forward,) + rest][::-1]
+
+        pieces = []
+        offset = 0
+        for part in self.parts:
+            m = len(part)
+            # First selected index in this part
+            start = indices.start
+            if start < offset:
+                start += -(-(offset - start) // indices.step) * indices.step
+            stop = min(indices.stop, offset + m)
+            if start < stop:
+                pieces.append(self.get(part, slice(start - offset, stop - offset,
+                                                   indices.step), rest))
+            offset += m
+        if not pieces:
+            return self.get(self.parts[0], slice(0, 0), rest)
+        return np.concatenate(pieces)
+
+
+class MemmapArray(LazyScanArray):
+    """Lazy view of an array of a npy recording: a list of memory-mapped
+    segments of segment_scans scans each, of which length() are valid.
+    Has the interface of ScanArray for integers and slices on the first
+    axis. Positive slices within a segment are returned as views of the
+    memory map (for unscaled data), others are copied. The list of
+    segments may grow while the recording is written."""
+    def __init__(self, segments, segment_scans, length, dtype, scan_shape, attrs=None,
+                 scaled=True):
+        self.segments = segments
+        self.segment_scans = segment_scans
+        self.length = length
+        self.stored_dtype = np.dtype(dtype)
+        self.scan_shape = tuple(scan_shape)
+        self.attrs = {} if attrs is None else attrs
+        self.scan_major = True
+        super().__init__(scaled)
+
+    @property
+    def shape(self):
+        return (self.length(),) + self.scan_shape
+
+    def __len__(self):
+        return self.length()
+
+    def __getitem__(self, key):
+        indices, rest = scan_indices(key, len(self))
+        segment = indices // self.segment_scans
+        offsets = indices - segment * self.segment_scans
+
+        if len(indices) == 0:
+            data = np.empty((0,) + self.scan_shape, dtype=self.stored_dtype)
+        elif segment[0] == segment[-1] and (len(indices) == 1 or indices[1] > indices[0]):
+            # Within one segment, a view
+            step = indices[1] - indices[0] if len(indices) > 1 else 1
+            data = self.segments[segment[0]][offsets[0]:offsets[-1]+1:step]
+        else:
+            # Pieces of consecutive scans of the same segment
+            splits = np.flatnonzero(np.diff(segment)) + 1
+            data = np.concatenate([self.segments[s[0]][o]
+                                   for s, o in zip(np.split(segment, splits),
+                                                   np.split(offsets, splits))])
+        return select_scans(data, key, rest, self.scale_coeffs)
+
+
+class Recording:
+    """Base class of the recordings: scans, electrodes, command and ts are
+    lazy scan-major arrays. Use as a context manager or call close()."""
+    @property
+    def n_electrodes(self):
+        return len(self.electrodes)
+
+    @property
+    def samples_per_scan(self):
+        return self.scans.shape[1]
+
+    def __len__(self):
+        return len(self.scans)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class NpyRecording(Recording):
+    """A recording in the npy storage (see the module docstring), with the
+    interface of FscvFile. The number of scans is read from the metadata
+    when the recording is opened; gaps and flushes are numpy arrays."""
+    def __init__(self, dirname):
+        self.dirname = str(dirname)
+        self.metadata = read_npy_metadata(self.dirname)
+        metadata = self.metadata
+        n_scans = metadata['n_scans']
+        segment_scans = metadata['segment_scans']
+        n_segments = -(-n_scans // segment_scans)
+        samples = (metadata['samples_per_scan'],)
+
+        def array(name, dtype, scan_shape, attrs=None):
+            segments = [np.load(npy_segment_filename(self.dirname, name, i), mmap_mode='r')
+                        for i in range(n_segments)]
+            return MemmapArray(segments, segment_scans, lambda: n_scans, dtype, scan_shape,
+                               attrs)
+
+        channels = [array(name, metadata['sample_format'], samples, metadata['channels'][name])
+                    for name in npy_channel_names(metadata['n_electrodes'])]
+        self.command = channels[0]
+        self.electrodes = channels[1:]
+        self.scans = self.electrodes[0]
+        self.ts = array('ts', np.float64, ())
+        self.timing = array('timing', np.float64, (len(metadata['timing_columns']),))
+        self.gaps = self.events('gaps')
+        self.flushes = self.events('flushes')
+        self.command_stats = None
+        self.scan_mean = self.scan_var = None
+        self.n_scans_statistics = metadata.get('statistics_n_scans', 0)
+        if self.n_scans_statistics:
+            self.scan_mean = np.load(os.path.join(self.dirname, 'stats_mean.npy'))
+            self.scan_var = np.load(os.path.join(self.dirname, 'stats_var.npy'))
+
+    def events(self, name):
+        events = self.metadata[name]
+        return np.array(events['rows'], dtype=np.float64).reshape(-1, len(events['columns']))
+
+    @property
+    def attrs(self):
+        return self.metadata['attrs']
+
+
+class FscvFile(Recording):
+    """An FSCV recording with scan-major access to scans, command and ts.
+
+    fileh can be a filename or an already opened tables.File (e.g. the file
+    a grabber is writing to). Files opened by FscvFile are closed by close()
+    or when used as a context manager."""
+    def __init__(self, fileh, mode='r'):
+        if isinstance(fileh, tb.File):
+            self.fileh = fileh
+            self.owns_file = False
+        else:
+            self.fileh = tb.open_file(str(fileh), mode=mode)
+            self.owns_file = True
+
+        root = self.fileh.root
+        self.electrodes = []
+        while scans_array_name(len(self.electrodes)) in root:
+            self.electrodes.append(scan_array(root[scans_array_name(len(self.electrodes))]))
+        self.scans = self.electrodes[0]
+        self.command = command_array(root)
+        self.ts = TimeArray(root.array_ts)
+        # Per-scan timing (n_scans, 4), gap events (n_gaps, 4) and the flush
+        # log (n_flushes, 3), only in newer files
+        self.timing = getattr(root, 'array_timing', None)
+        self.gaps = getattr(root, 'array_gaps', None)
+        self.flushes = getattr(root, 'array_flushes', None)
+        # Deviation of the command from its template (n_scans, 3), only with
+        # command_mode 'template'
+        self.command_stats = getattr(root, 'array_command_stats', None)
+        # Mean and variance of every sample over all scans, see the module
+        # docstring. Only in newer files that were closed properly.
+        self.scan_mean = self.scan_var = None
+        self.n_scans_statistics = 0
+        if 'array_stats_mean' in root:
+            self.scan_mean = root.array_stats_mean[:]
+            self.scan_var = root.array_stats_var[:]
+            self.n_scans_statistics = int(root.array_stats_mean.attrs['n_scans'])
+
+    @property
+    def attrs(self):
+        """Recording parameters are stored as attributes of array_ts"""
+        return self.ts.attrs
+
+    def close(self):
+        if self.owns_file:
+            self.fileh.close()
+
+
+class SegmentedFscvFile(Recording):
+    """A recording split into segments, read through its manifest.
+
+    Has the interface of FscvFile: scans, electrodes, command, ts, timing
+    and gaps are ConcatArrays over the segments. The scan indices in gaps
+    count from the start of the recording."""
+    def __init__(self, manifest_filename):
+        self.manifest = read_manifest(manifest_filename)
+        folder = os.path.dirname(os.path.abspath(manifest_filename))
+        self.segments = [open_recording(os.path.join(folder, s['filename']))
+                         for s in self.manifest['segments']]
+
+        first = self.segments[0]
+        self.electrodes = [ConcatArray([s.electrodes[i] for s in self.segments])
+                           for i in range(first.n_electrodes)]
+        self.scans = self.electrodes[0]
+        self.command = ConcatArray([s.command for s in self.segments])
+        self.ts = ConcatArray([s.ts for s in self.segments])
+        self.timing = None
+        self.gaps = None
+        self.flushes = None
+        self.command_stats = None
+        if first.timing is not None:
+            self.timing = ConcatArray([s.timing for s in self.segments])
+            self.gaps = ConcatArray([s.gaps for s in self.segments])
+        if first.flushes is not None:
+            self.flushes = ConcatArray([s.flushes for s in self.segments])
+        if all(s.command_stats is not None for s in self.segments):
+            self.command_stats = ConcatArray([s.command_stats for s in self.segments])
+
+        # The statistics of the whole recording are merged from the segments
+        self.scan_mean = self.scan_var = None
+        self.n_scans_statistics = 0
+        if all(s.scan_mean is not None for s in self.segments):
+            n, mean, m2 = 0, 0.0, 0.0
+            for s in self.segments:
+                n, mean, m2 = merge_statistics(n, mean, m2, s.n_scans_statistics,
+                                               s.scan_mean, s.scan_var * s.n_scans_statistics)
+            self.scan_mean, self.scan_var, self.n_scans_statistics = mean, m2 / n, n
+
+    @property
+    def attrs(self):
+        return self.segments[0].attrs
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+def open_recording(filename):
+    """FscvFile for a .h5 file, SegmentedFscvFile for a manifest,
+    NpyRecording for a npy recording (the directory or its metadata.json)"""
+    filename = str(filename)
+    if os.path.isdir(filename):
+        return NpyRecording(filename)
+    if os.path.basename(filename) == NPY_METADATA:
+        return NpyRecording(os.path.dirname(filename))
+    if filename.endswith('.json'):
+        return SegmentedFscvFile(filename)
+    return FscvFile(filename)
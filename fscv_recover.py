@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""Salvage the complete scans of a partially written recording.
+
+After a crash or power loss the last scans of a recording may be missing
+in some of the arrays, or the end of the file may be unreadable. The
+recording is consistent up to the last flush (see array_flushes). This
+tool copies every scan that is complete in all arrays (timestamp,
+command, all electrodes and timing) into a new file. Reading stops at the
+first block that can not be read.
+
+Segmented recordings are recovered segment by segment, given their
+manifest. The recovered segments get a new manifest.
+
+Usage:
+    python fscv_recover.py fscv0001.h5 [-o fscv0001_recovered.h5]
+    python fscv_recover.py fscv0001.json
+"""
+import os
+import sys
+import argparse
+import numpy as np
+import tables as tb
+
+import fscv_daq
+import fscv_reader
+
+# Errors of PyTables/HDF5 when reading a damaged file
+READ_ERRORS = (tb.HDF5ExtError, OSError, ValueError, KeyError, IndexError)
+
+
+def recovered_filename(filename):
+    root, ext = os.path.splitext(str(filename))
+    return '%s_recovered%s' % (root, ext)
+
+
+def recover_file(filename, out_filename=None, block_scans=1000):
+    """Copy the complete scans of filename into a new file. Returns the
+    new filename and the number of scans copied."""
+    if out_filename is None:
+        out_filename = recovered_filename(filename)
+
+    with fscv_reader.FscvFile(filename) as src:
+        channels = [src.command] + src.electrodes
+        lengths = [len(src.ts)] + [len(c) for c in channels]
+        if src.timing is not None:
+            lengths.append(src.timing.nrows)
+        n_complete = min(lengths)
+
+        node = src.scans.node
+        sample_format = node.attrs['sample_format'] if 'sample_format' in node.attrs \
+            else node.dtype.name
+
+        # Template command files are recovered as such, with their statistics,
+        # delta encoded files with their encoding
+        storage_kwargs = {}
+        if 'scan_encoding' in node.attrs:
+            storage_kwargs.update(scan_encoding=node.attrs['scan_encoding'],
+                                  reference_every=int(node.attrs['reference_every']))
+        if src.command_stats is not None:
+            attrs = src.command.attrs
+            storage_kwargs.update(command_mode='template',
+                                  command_threshold=attrs['command_threshold'],
+                                  command_keep_every=attrs['command_keep_every'])
+
+        out = fscv_daq.ScanFile(out_filename, n_electrodes=src.n_electrodes,
+                                samples_per_scan=src.samples_per_scan,
+                                sample_format=sample_format,
+                                scan_major=src.scans.scan_major,
+                                complevel=node.filters.complevel,
+                                complib=node.filters.complib or 'blosc',
+                                shuffle=fscv_daq.filters_shuffle(node.filters),
+                                expectedrows=max(n_complete, 1),
+                                **storage_kwargs)
+
+        # Recording parameters and scaling
+        out.set_attrs({name: src.attrs[name] for name in src.attrs._v_attrnamesuser})
+        out.set_attrs({'recovered_from': os.path.basename(str(filename))})
+        if src.scans.scale_coeffs is not None:
+            out.set_scale_coeffs([c.scale_coeffs for c in channels])
+
+        n_copied = 0
+        for start in range(0, n_complete, block_scans):
+            stop = min(start + block_scans, n_complete)
+            try:
+                ts = src.ts[start:stop]
+                data = np.stack([c.raw[start:stop] for c in channels], axis=1)
+                if src.timing is not None:
+                    timing = src.timing[start:stop]
+                else:
+                    timing = np.full((stop - start, len(fscv_daq.TIMING_COLUMNS)), np.nan)
+                command_stats = None
+                if src.command_stats is not None:
+                    command_stats = src.command_stats[start:stop]
+            except READ_ERRORS as e:
+                print('Unreadable from scan %i: %s' % (start, e))
+                break
+            out.append(ts, data, timing, command_stats)
+            n_copied = stop
+
+        # Gap events within and flushes up to the recovered scans
+        scan_column = {'gaps': fscv_daq.GAP_COLUMNS.index('scan_index'),
+                       'flushes': fscv_daq.FLUSH_COLUMNS.index('n_scans')}
+        for name in ['gaps', 'flushes']:
+            events = getattr(src, name)
+            if events is None or events.nrows == 0:
+                continue
+            try:
+                events = events[:]
+            except READ_ERRORS as e:
+                print('Unreadable %s: %s' % (name, e))
+                continue
+            scans = events[:, scan_column[name]]
+            if name == 'gaps':
+                events = events[scans < n_copied]
+            else:
+                events = events[scans <= n_copied]
+            if len(events):
+                getattr(out, 'array_' + name).append(events)
+
+        if n_copied < len(src.ts) or n_copied < len(src.scans):
+            print('%s: %i scans recovered, %i incomplete scans dropped'
+                  % (filename, n_copied, max(lengths) - n_copied))
+        else:
+            print('%s: %i scans recovered' % (filename, n_copied))
+        out.close()
+    return out_filename, n_copied
+
+
+def recover_segments(manifest_filename):
+    """Recover all segments of a segmented recording. Segments that can not
+    be opened are skipped. Returns the new manifest filename."""
+    manifest = fscv_reader.read_manifest(manifest_filename)
+    folder = os.path.dirname(os.path.abspath(manifest_filename))
+
+    segments = []
+    first_scan = 0
+    for segment in manifest['segments']:
+        filename = os.path.join(folder, segment['filename'])
+        try:
+            out_filename, n_scans = recover_file(filename)
+        except READ_ERRORS as e:
+            print('%s: can not be opened, skipped: %s' % (filename, e))
+            continue
+        segments.append({'filename': os.path.basename(out_filename),
+                         'first_scan': first_scan, 'n_scans': n_scans})
+        first_scan += n_scans
+
+    out_manifest = recovered_filename(manifest_filename)
+    fscv_reader.write_manifest(out_manifest, {'segments': segments, 'complete': True,
+                                              'recovered_from': os.path.basename(
+                                                  manifest_filename)})
+    return out_manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Salvage the complete scans of a '
+                                     'partially written FSCV recording')
+    parser.add_argument('filename', help='.h5 file or manifest (.json) of a recording')
+    parser.add_argument('-o', '--output', help='recovered .h5 file (not for manifests)')
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.filename):
+        print('%s: npy recordings are readable up to the last flush without recovery'
+              % args.filename)
+        return 0
+    if args.filename.endswith('.json'):
+        print('saved: ', recover_segments(args.filename))
+    else:
+        try:
+            out_filename, _ = recover_file(args.filename, args.output)
+        except READ_ERRORS as e:
+            print('%s can not be opened: %s' % (args.filename, e))
+            return 1
+        print('saved: ', out_filename)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Live plots of the GUI in the render process of a RemoteGraphicsView.
+
+The GUI imports this module in the render process and creates one LivePlots
+there. Every GUI update sends a single message with the latest scan and,
+only when it changed, the command (see FscvWin.send_plots). The render
+process measures the latency of the messages; the GUI fetches the
+statistics with take_latency.
+"""
+import time
+import pickle
+import numpy as np
+import pyqtgraph as pg
+
+
+class LivePlots:
+    """Current, command and duck (current vs command) plot in one view"""
+    def __init__(self, view):
+        layout = pg.GraphicsLayout()
+        view.setCentralItem(layout)
+        self.current_plot = layout.addPlot(title='Scan')
+        layout.nextRow()
+        self.command_plot = layout.addPlot(title='Command')
+        layout.nextRow()
+        self.duck_plot = layout.addPlot(title='Duck')
+        self.current_curve = self.current_plot.plot()
+        self.command_curve = self.command_plot.plot()
+        self.duck_curve = self.duck_plot.plot()
+        self.command = None
+
+        self.latency_sum = 0
+        self.latency_max = 0
+        self.n_messages = 0
+
+    def update(self, message, t_sent):
+        """message: pickled (current, command), command is None if it did not
+        change. t_sent: time.perf_counter() of the GUI when it was sent."""
+        current, command = pickle.loads(message)
+        if command is not None:
+            self.command = command
+            self.command_curve.setData(command)
+        self.current_curve.setData(current)
+        if self.command is not None and len(self.command) == len(current):
+            self.duck_curve.setData(x=self.command, y=current)
+
+        latency = time.perf_counter() - t_sent
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.n_messages += 1
+
+    def take_latency(self):
+        """Mean and maximum latency [s] of the messages since the previous
+        call, NaN without messages"""
+        if self.n_messages == 0:
+            return np.nan, np.nan
+        latency = (self.latency_sum / self.n_messages, self.latency_max)
+        self.latency_sum = 0
+        self.latency_max = 0
+        self.n_messages = 0
+        return latency
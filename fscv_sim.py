@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Synthetic FSCV data.
+
+FscvSimulator generates realistic scans in vectorized blocks: a triangular
+command waveform, a large capacitive background current and dopamine-like
+oxidation/reduction peaks that follow concentration transients. Background
+drift and noise are added on top. fscv_backends.SimulatorBackend delivers
+the blocks to a grabber.
+
+All values are in volts as seen by the ADC: channel 0 is the command
+voltage, channels 1..n_electrodes the amplifier outputs of the currents.
+"""
+import numpy as np
+
+
+class FscvSimulator:
+    """Generator of synthetic FSCV scans.
+
+    transients is a list of (t_start, concentration, tau_rise, tau_decay)
+    tuples in seconds and uM. If None, a 1 uM transient is released every
+    transient_period seconds. With drop_probability > 0 scans are randomly
+    skipped, like scans that the DAQ overwrote. n_scans_generated counts
+    the skipped scans too, like the sample counter of the DAQ."""
+    def __init__(self,
+                 samples_per_scan = 1000,
+                 rate = 100e3,
+                 scan_frequency = 10,
+                 holding_potential = -0.4,
+                 switching_potential = 1.3,
+                 ramp_rate = 400,
+                 background_amplitude = 2.0,
+                 background_tau = 2e-4,
+                 peak_amplitude = 0.05,
+                 transients = None,
+                 transient_period = 5,
+                 drift = 0.02,
+                 noise = 5e-3,
+                 drop_probability = 0,
+                 n_electrodes = 1,
+                 seed = None,
+                 ):
+        self.samples_per_scan = samples_per_scan
+        self.rate = rate
+        self.scan_frequency = scan_frequency
+        self.peak_amplitude = peak_amplitude
+        self.transients = transients
+        self.transient_period = transient_period
+        self.drift = drift
+        self.noise = noise
+        self.drop_probability = drop_probability
+        self.n_electrodes = n_electrodes
+        self.rng = np.random.default_rng(seed)
+        self.n_scans_generated = 0
+
+        # Triangular command: up and down at ramp_rate, the rest of the
+        # scan at the holding potential. Faster ramp if the scan is too short
+        t = np.arange(samples_per_scan) / rate
+        amplitude = switching_potential - holding_potential
+        ramp_rate = max(ramp_rate, 2 * amplitude / (0.9 * samples_per_scan / rate))
+        t_switch = amplitude / ramp_rate
+        triangle = np.where(t < t_switch, t * ramp_rate, 2 * amplitude - t * ramp_rate)
+        self.command = holding_potential + np.clip(triangle, 0, None)
+
+        # Capacitive current follows dV/dt, smoothed by the cell's RC
+        dvdt = np.gradient(self.command, 1 / rate)
+        kernel = np.exp(-np.arange(samples_per_scan) / (background_tau * rate))
+        capacitive = np.convolve(dvdt, kernel / kernel.sum())[:samples_per_scan]
+        self.background = background_amplitude * capacitive / ramp_rate
+
+        # Dopamine: oxidation at ~0.6 V on the anodic sweep, reduction at
+        # ~-0.2 V on the cathodic sweep
+        anodic = dvdt > 0
+        cathodic = dvdt < 0
+        self.faradaic = (anodic * np.exp(-((self.command - 0.6) / 0.1)**2)
+                         - 0.7 * cathodic * np.exp(-((self.command + 0.2) / 0.12)**2))
+
+        # Electrodes differ in background size and sensitivity
+        self.electrode_gain = 1 + 0.1 * np.arange(n_electrodes)
+        self.electrode_sensitivity = 1 / (1 + 0.5 * np.arange(n_electrodes))
+
+    def concentration(self, t):
+        """Dopamine concentration [uM] at the times t"""
+        c = np.zeros_like(t)
+        if self.transients is None:
+            # Periodic release, starting one period after the recording
+            t_rel = t % self.transient_period
+            released = t >= self.transient_period
+            c += released * (1 - np.exp(-t_rel / 0.2)) * np.exp(-t_rel / 1.0)
+        else:
+            for t_start, amplitude, tau_rise, tau_decay in self.transients:
+                t_rel = np.clip(t - t_start, 0, None)
+                c += amplitude * (1 - np.exp(-t_rel / tau_rise)) * np.exp(-t_rel / tau_decay)
+        return c
+
+    def generate(self, n_scans):
+        """Next n_scans scans as array (n_scans, 1+n_electrodes, samples_per_scan)"""
+        i = self.n_scans_generated + np.arange(n_scans)
+        t = i / self.scan_frequency
+        self.n_scans_generated += n_scans
+
+        # Slow drift of the background: linear plus a slow oscillation
+        drift = 1 + self.drift * (t / 60 + 0.5 * np.sin(2 * np.pi * t / 300))
+        c = self.concentration(t)
+
+        data = np.empty((n_scans, 1 + self.n_electrodes, self.samples_per_scan))
+        data[:, 0] = self.command
+        background = drift[:, np.newaxis] * self.background
+        peaks = (self.peak_amplitude * c)[:, np.newaxis] * self.faradaic
+        data[:, 1:] = (self.electrode_gain[:, np.newaxis, np.newaxis] * background
+                       + self.electrode_sensitivity[:, np.newaxis, np.newaxis] * peaks
+                       ).swapaxes(0, 1)
+        data += self.rng.normal(scale=self.noise, size=data.shape)
+        return data
+
+    def read_block(self, out):
+        """Fill out (channels, n_scans * samples_per_scan), like a DAQ read of
+        n_scans consecutive scans. Integer buffers get ADC codes for a
+        +-10 V range."""
+        n_scans = out.shape[1] // self.samples_per_scan
+        if self.drop_probability:
+            # Skipped scans only advance the counter
+            self.n_scans_generated += self.rng.binomial(n_scans, self.drop_probability)
+        data = self.generate(n_scans).swapaxes(0, 1).reshape(out.shape[0], -1)
+        if np.issubdtype(out.dtype, np.integer):
+            info = np.iinfo(out.dtype)
+            data = np.clip(np.round(data / (10 / (info.max + 1))), info.min, info.max)
+        out[:] = data
+        return out
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Valve control with symphonies, independent of the GUI.
+
+A symphony is a section of symphonies.ini: keys are times in seconds after
+the start of the recording, values are chords of 0/1 valve states (two
+valves per ECU). The chord 'final_chord' is applied when the recording
+stops.
+"""
+try:
+    from ecu import ECUManager
+    VALVES_CONNECTED = True
+except ModuleNotFoundError:
+    VALVES_CONNECTED = False
+
+FINAL_CHORD = "final_chord"
+
+
+def symphony_chords(symphony):
+    """List of (time [s], chord) of a symphony section, sorted by time.
+    Raises ValueError for invalid chords or times."""
+    chords = []
+    for k in symphony:
+        if k == FINAL_CHORD:
+            # Final chord is not part of the list
+            continue
+        chord = symphony[k].strip()
+        if chord.replace('0', '').replace('1', '').strip() != '':
+            raise ValueError('Invalid character in chord: %s . Only 0 and 1 allowed.'%chord)
+        chords.append((float(k), chord))
+    return sorted(chords)
+
+
+class ValveController:
+    """The valve ECUs configured in the ECUS section of the config.
+
+    Without the ecu package, or for ECUs that are not connected, chords are
+    only remembered in state."""
+    def __init__(self, ecu_config, n_ecus=4):
+        self.ecus = [None] * n_ecus
+        self.state = ''
+        self.errors = []
+        if not VALVES_CONNECTED:
+            return
+
+        self.ecu_manager = ECUManager()
+        for ecu in self.ecu_manager.get_all():
+            print('Connected: ', ecu)
+
+        for i in range(n_ecus):
+            try:
+                self.ecus[i] = self.ecu_manager.get_by_uuid(ecu_config['ECU_%i'%(i+1)])
+                print("Identified ecu position %i"%(i+1), self.ecus[i])
+            except KeyError:
+                print("Ecu position %i not configured"%(i+1))
+            except ValueError:
+                ecu_error = "Ecu %s not connected"%ecu_config['ECU_%i' % (i + 1)]
+                print(ecu_error)
+                self.errors.append(ecu_error)
+        if self.errors:
+            print("Valve ECU connection error", str(self.errors))
+
+    def set(self, chord):
+        """Set the valves to a chord like '1100 0000'"""
+        bool_chord = [x=="1" for x in chord.replace(' ', '')]
+        for i, ecu in enumerate(self.ecus):
+            if ecu is None:
+                continue
+            ecu.set_enabled(1, bool_chord[i*2])
+            ecu.set_enabled(2, bool_chord[1+i*2])
+        self.state = chord.replace(' ', '_')
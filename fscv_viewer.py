@@ -1,13 +1,13 @@
 import sys
 import os
-import numpy as np
 import pyqtgraph as pg
-import tables as tb
 
-from PyQt5.QtWidgets import *
-from PyQt5.QtCore import *
+from PyQt5.QtWidgets import (QApplication, QFileSystemModel, QHBoxLayout, QListView,
+                             QTreeView, QWidget)
+from PyQt5.QtCore import QDir
 
 import labtools
+import fscv_reader
 
 class Widget(QWidget):
     def __init__(self, *args, **kwargs):
@@ -43,10 +43,10 @@ class Widget(QWidget):
 
     def list_clicked(self, index):
         data_filename = os.path.join(self.datapath, self.selected_path, index.data())
-        data_file = tb.open_file(data_filename)
-        dat = data_file.root.array_scans
-        #dat = data_file.root.array_command
-        img_view = pg.image(np.array(dat))
+        with fscv_reader.open_recording(data_filename) as data_file:
+            dat = data_file.scans[:]
+            #dat = data_file.command[:]
+        img_view = pg.image(dat)
         img_view.view.setAspectLocked(False)
 
 